@@ -22,6 +22,8 @@ from finac.core import ResourceAlreadyExists
 from finac.core import asset_create, asset_delete
 from finac.core import asset_set_rate, asset_rate
 from finac.core import asset_delete_rate, asset_rate_range
+from finac.core import asset_rate_vector
+from finac.core import asset_set_rates_bulk, asset_import_rates
 
 from finac.core import asset_update
 from finac.core import asset_precision
@@ -39,8 +41,11 @@ from finac.core import archive_transactions
 from finac.core import transaction_create, transaction_complete
 from finac.core import transaction_move, transaction_delete
 from finac.core import transaction_copy
+from finac.core import transaction_move_many, transaction_create_many
+from finac.core import transaction_post
 
 from finac.core import transaction_update, transaction_apply
+from finac.core import transaction_import
 
 # balance methods
 from finac.core import account_credit, account_debit, account_balance
@@ -56,6 +61,12 @@ from finac.core import purge, transaction_purge, cleanup
 # caches
 from finac.core import preload, exec_query
 
+# remote calls
+from finac.core import batch
+
+# units of work
+from finac.core import session, atomic
+
 # plots
 from finac.plot import account_plot as plot
 from finac.plot import account_pie as pie
@@ -1,13 +1,16 @@
 import time
 import datetime
+import threading
 
-from flask import Flask, jsonify, request, Response
+from flask import Flask, jsonify, request, Response, g
 
 from finac import core, ResourceNotFound, RateNotFound, ResourceAlreadyExists
 from finac import OverdraftError, OverlimitError
-from finac.core import get_db, logger, exec_query, spawn
+from finac.core import get_db, logger, exec_query, spawn, session
+from finac.core import msgpack, msgpack_packb, msgpack_unpackb, MSGPACK_MIME
 
 from types import GeneratorType
+from collections.abc import Iterator
 
 app = Flask('finac')
 
@@ -17,6 +20,27 @@ key = None
 
 real_ip_header = None
 
+# max calls of a single JSON RPC batch, executed in parallel
+batch_concurrency = 10
+
+# methods which don't modify data and may be executed in parallel. Other
+# methods are executed one by one, after all previous calls are finished
+parallel_methods = {
+    'asset_precision', 'get_version', 'format_amount', 'asset_list',
+    'asset_list_rates', 'asset_rate', 'asset_rate_vector', 'account_info',
+    'transaction_info', 'account_statement', 'account_statement_summary',
+    'account_list', 'account_list_summary', 'account_credit', 'account_debit',
+    'account_balance', 'asset_rate_range', 'account_balance_range'
+}
+
+
+# account lock methods, locks of which can not be kept between requests in the
+# database lock mode or in SQLite WAL mode
+lock_methods = {
+    'account_lock', 'account_unlock', 'account_lock_many',
+    'account_unlock_many'
+}
+
 
 def get_real_ip():
     return request.headers.get(real_ip_header, request.remote_addr) if \
@@ -27,6 +51,96 @@ class AccessDenied(Exception):
     pass
 
 
+NDJSON_MIME = 'application/x-ndjson'
+
+
+def _msgpack_default(obj):
+    try:
+        return core._msgpack_default(obj)
+    except TypeError:
+        return app.json.default(obj)
+
+
+def _request_data():
+    """
+    Get request payload, JSON or MessagePack
+    """
+    if msgpack and request.mimetype == MSGPACK_MIME:
+        return msgpack_unpackb(request.get_data())
+    else:
+        return request.json
+
+
+def _response(data):
+    """
+    Serialize response data as MessagePack if requested by client, otherwise
+    as JSON
+    """
+    if msgpack and request.accept_mimetypes.best_match(
+        ['application/json', MSGPACK_MIME]) == MSGPACK_MIME:
+        return Response(msgpack_packb(data, default=_msgpack_default),
+                        mimetype=MSGPACK_MIME)
+    else:
+        return jsonify(data)
+
+
+def _stream_requested():
+    return request.args.get('stream') == '1' or \
+        request.accept_mimetypes.best_match(
+            ['application/json', NDJSON_MIME]) == NDJSON_MIME
+
+
+def _prefetch(gen):
+    """
+    Get the first generator item to raise possible errors before the
+    response is started
+    """
+    try:
+        first = next(gen)
+    except StopIteration:
+        return iter(())
+
+    def _gen():
+        yield first
+        yield from gen
+
+    return _gen()
+
+
+def _ndjson_response(rows, on_error):
+    """
+    Stream rows as NDJSON. If an exception is raised during streaming, a line
+    returned by on_error(exception) is sent and streaming is stopped
+    """
+
+    def _gen():
+        try:
+            for row in rows:
+                yield app.json.dumps(row) + '\n'
+        except Exception as e:
+            yield app.json.dumps(on_error(e)) + '\n'
+
+    response = Response(_gen(), mimetype=NDJSON_MIME)
+    # keep the request DB session until streaming is finished
+    s = g.pop('finac_session', None)
+    if s is not None:
+        response.call_on_close(lambda: s.__exit__(None, None, None))
+    return response
+
+
+@app.before_request
+def _session_start():
+    g.finac_session = session()
+    g.finac_session.__enter__()
+
+
+@app.teardown_request
+def _session_end(e=None):
+    s = g.pop('finac_session', None)
+    if s is not None:
+        s.__exit__(None, None, None)
+
+
 @app.route('/ping')
 def ping():
     get_db()
@@ -51,7 +165,8 @@ def query_post():
     result = _check_x_auth_key(log_from)
     if result is not True:
         return result
-    if isinstance(request.json, list):
+    payload = _request_data()
+    if isinstance(payload, list):
         futures = [
             spawn(query,
                   q,
@@ -59,10 +174,10 @@ def query_post():
                   _check_perm=False,
                   log_from=log_from,
                   _time_ms=request.args.get('time_ms') == '1')
-            for q in request.json
+            for q in payload
             if q
         ]
-        return jsonify([f.result() for f in futures])
+        return _response([f.result() for f in futures])
     else:
         return Response('Input JSON should be list of queries', status=400)
 
@@ -74,7 +189,7 @@ def query(q=None,
           log_from=None,
           _time_ms=None):
 
-    def _response(text, status):
+    def _error(text, status):
         if _return_raw:
             return {'error': text}
         else:
@@ -96,10 +211,17 @@ def query(q=None,
         need_ts = False
     logger.info(f'{log_from}, query: \'{q}\'')
     if q is None:
-        return _response('q param is required', status=400)
+        return _error('q param is required', status=400)
     try:
         if _time_ms is None:
             _time_ms = request.args.get('time_ms') == '1'
+        if not _return_raw and not _time_ms and _stream_requested():
+
+            def _on_error(e):
+                logger.warning(f'{log_from} query error: {e}')
+                return {'error': str(e)}
+
+            return _ndjson_response(_prefetch(iter(exec_query(q))), _on_error)
         t_start = time.time()
         result = list(exec_query(q, _time_ms=_time_ms))
         t_spent = time.time() - t_start
@@ -128,8 +250,8 @@ def query(q=None,
                         gres['columns'].append(col)
                 if need_ts:
                     if len(timecols) > 1 or (timecols and len(result[0]) > 2):
-                        return _response('Unsupported time series query',
-                                         status=405)
+                        return _error('Unsupported time series query',
+                                      status=405)
                     else:
                         if timecols:
                             tc_name = timecols[0]
@@ -156,7 +278,7 @@ def query(q=None,
                             r[c].timestamp() * 1000 if c in timecols else r[c]
                             for c in cols
                         ])
-            return gres if _return_raw else jsonify(gres)
+            return gres if _return_raw else _response(gres)
         else:
             result = {
                 'ok': True,
@@ -164,85 +286,154 @@ def query(q=None,
                 'rows': len(result),
                 'time': t_start
             }
-            return result if _return_raw else jsonify(result)
+            return result if _return_raw else _response(result)
     except (LookupError, ResourceNotFound, RateNotFound) as e:
-        return _response('Lookup error ' + str(e), status=404)
+        return _error('Lookup error ' + str(e), status=404)
     except (ResourceAlreadyExists, OverdraftError, OverlimitError) as e:
-        return _response('Already exists ' + str(e), status=409)
+        return _error('Already exists ' + str(e), status=409)
     except (TypeError, ValueError) as e:
-        return _response(str(e), status=400)
+        return _error(str(e), status=400)
     except Exception as e:
-        return _response(str(e), status=500)
+        return _error(str(e), status=500)
 
 
 @app.route('/jrpc', methods=['POST'])
 def jrpc():
-    payload = request.json
-    response = []
-    for req in payload if isinstance(payload, list) else [payload]:
-        log_from = 'FINAC API request from ' + get_real_ip()
-
+    payload = _request_data()
+    log_from = 'FINAC API request from ' + get_real_ip()
+    reqs = payload if isinstance(payload, list) else [payload]
+    for req in reqs:
         if not req or req.get('jsonrpc') != '2.0':
             logger.warning(f'{log_from} unsupported protocol')
             return Response('Unsupported protocol', status=405)
-        i = req.get('id')
-        if i is not None:
-            resp = {'jsonrpc': '2.0', 'id': i}
+    if len(reqs) > 1 and batch_concurrency > 1:
+        response = _jrpc_batch(reqs, log_from)
+    elif not isinstance(payload, list) and _stream_requested():
+        resp = _jrpc_call(payload, log_from, stream=True)
+        if resp and isinstance(resp.get('result'), Iterator):
 
-        def append_error(code, message=''):
-            if i is not None:
-                resp['error'] = {'code': code, 'message': message}
+            def _on_error(e):
+                code, message = _jrpc_error(e, log_from)
+                return {
+                    'jsonrpc': '2.0',
+                    'id': resp['id'],
+                    'error': {
+                        'code': code,
+                        'message': message
+                    }
+                }
 
-        try:
-            params = req.get('params', {})
-            if key is not None and key != params.get('_k'):
-                raise AccessDenied
-            if '_k' in params:
-                del params['_k']
-            logger.info(f'{log_from} {req["method"]}')
-            logger.debug(req.get('params'))
-            result = getattr(core, req['method'])(**req.get('params', {}))
-            if isinstance(result, GeneratorType):
-                result = list(result)
-            if i is not None:
-                resp['result'] = result
-        except AccessDenied:
-            logger.error(f'{log_from} access denied')
-            append_error(-32000, 'Access denied')
-        except ResourceNotFound as e:
-            logger.info(f'{log_from} resource not found')
-            append_error(-32001, str(e))
-        except RateNotFound as e:
-            logger.info(f'{log_from} rate not found')
-            append_error(-32002, str(e))
-        except OverdraftError as e:
-            logger.info(f'{log_from} overdraft error')
-            append_error(-32003, str(e))
-        except OverlimitError as e:
-            logger.info(f'{log_from} overlimit error')
-            append_error(-32004, str(e))
-        except ResourceAlreadyExists as e:
-            logger.info(f'{log_from} resource already exists')
-            append_error(-32005, str(e))
-        except AttributeError:
-            logger.warning(f'{log_from} method not found')
-            append_error(-32601, 'Method not found')
-        except TypeError:
-            logger.warning(f'{log_from} invalid params')
-            append_error(-32602, 'Invalid params')
-        except ValueError:
-            logger.warning(f'{log_from} invalid value')
-            append_error(-32603, 'Invalid value')
-        except Exception as e:
-            logger.warning(f'{log_from} unknown error')
-            append_error(-32699, str(e))
-        if i is not None:
-            response.append(resp)
+            return _ndjson_response(resp['result'], _on_error)
+        response = [resp]
+    else:
+        response = [_jrpc_call(req, log_from) for req in reqs]
+    response = [resp for resp in response if resp is not None]
     if response:
-        return jsonify(response) if isinstance(payload, list) else response[0]
+        return _response(response if isinstance(payload, list) else response[0])
     else:
         return Response(status=204)
 
 
+def _jrpc_batch(reqs, log_from):
+    """
+    Execute batch calls in the thread pool
+
+    Calls of parallel methods are executed concurrently, other calls wait
+    until all previous ones are finished. Results are returned in request
+    order
+    """
+    sem = threading.BoundedSemaphore(batch_concurrency)
+
+    def _call(req):
+        try:
+            return _jrpc_call(req, log_from)
+        finally:
+            sem.release()
+
+    futures = []
+    for req in reqs:
+        parallel = req.get('method') in parallel_methods
+        if not parallel:
+            for f in futures:
+                f.result()
+        sem.acquire()
+        futures.append(spawn(_call, req))
+        if not parallel:
+            futures[-1].result()
+    return [f.result() for f in futures]
+
+
+def _jrpc_call(req, log_from, stream=False):
+    """
+    Execute JSON RPC call
+
+    If stream is True, generator results are not collected and returned as
+    iterators
+    """
+    i = req.get('id')
+    if i is not None:
+        resp = {'jsonrpc': '2.0', 'id': i}
+
+    try:
+        params = req.get('params', {})
+        if key is not None and key != params.get('_k'):
+            raise AccessDenied
+        if '_k' in params:
+            del params['_k']
+        if req['method'] in lock_methods and (core.config.lock_mode == 'db' or
+                                              core.config.sqlite_wal):
+            raise RuntimeError('Account locks can not be kept between API '
+                               'requests in the current lock mode')
+        logger.info(f'{log_from} {req["method"]}')
+        logger.debug(req.get('params'))
+        result = getattr(core, req['method'])(**req.get('params', {}))
+        if isinstance(result, GeneratorType):
+            result = _prefetch(result) if stream and i is not None else list(
+                result)
+        if i is not None:
+            resp['result'] = result
+    except Exception as e:
+        code, message = _jrpc_error(e, log_from)
+        if i is not None:
+            resp['error'] = {'code': code, 'message': message}
+    return resp if i is not None else None
+
+
+def _jrpc_error(e, log_from):
+    """
+    Log exception and get JSON RPC error code and message
+    """
+    if isinstance(e, AccessDenied):
+        logger.error(f'{log_from} access denied')
+        return -32000, 'Access denied'
+    elif isinstance(e, ResourceNotFound):
+        logger.info(f'{log_from} resource not found')
+        return -32001, str(e)
+    elif isinstance(e, RateNotFound):
+        logger.info(f'{log_from} rate not found')
+        return -32002, str(e)
+    elif isinstance(e, OverdraftError):
+        logger.info(f'{log_from} overdraft error')
+        return -32003, str(e)
+    elif isinstance(e, OverlimitError):
+        logger.info(f'{log_from} overlimit error')
+        return -32004, str(e)
+    elif isinstance(e, ResourceAlreadyExists):
+        logger.info(f'{log_from} resource already exists')
+        return -32005, str(e)
+    elif isinstance(e, AttributeError):
+        logger.warning(f'{log_from} method not found')
+        return -32601, 'Method not found'
+    elif isinstance(e, TypeError):
+        logger.warning(f'{log_from} invalid params')
+        return -32602, 'Invalid params'
+    elif isinstance(e, ValueError):
+        logger.warning(f'{log_from} invalid value')
+        return -32603, 'Invalid value'
+    else:
+        logger.warning(f'{log_from} unknown error')
+        return -32699, str(e)
+
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', debug=True)
@@ -7,17 +7,20 @@ __version__ = '0.5.8'
 from sqlalchemy.exc import IntegrityError
 from cachetools import TTLCache
 from itertools import groupby
+from bisect import bisect_left, bisect_right
 from .currencies import currencies
 from types import SimpleNamespace
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, Future
 
-_cache = SimpleNamespace(rate=None, rate_list=None)
+_cache = SimpleNamespace(rate=None, rate_list=None, account=None, asset=None)
 
 _CacheRateKeyError = KeyError
 _CacheRateListKeyError = KeyError
 
 _asset_precision_cache = {}
 
+_rate_index = {}
+
 restrict_assets_to_currencies = False
 
 # financial assets
@@ -86,8 +89,6 @@ PASSIVE_ACCOUNTS = [ACCOUNT_SUPPLIER, ACCOUNT_FINAGENT, ACCOUNT_TAX]
 
 ACCOUNT_TYPE_IDS = {v: k for k, v in ACCOUNT_TYPE_NAMES.items()}
 
-LOCK_DELAY = 0.1
-
 import sqlalchemy as sa
 import datetime
 import time
@@ -96,14 +97,20 @@ import random
 import os
 import logging
 import threading
+import json
+import queue
+import atexit
 
 from sqlalchemy import text as sql
 
 g = threading.local()
 
+_batch = threading.local()
+
 from types import SimpleNamespace
-from collections import OrderedDict
+from collections import OrderedDict, deque
 from functools import wraps
+from contextlib import contextmanager
 
 from pyaltt2.crypto import gen_random_str
 from pyaltt2.lp import parse_func_str
@@ -117,36 +124,65 @@ logger = logging.getLogger('finac')
 
 _db = SimpleNamespace(engine=None, redis_conn=None)
 
+_api = SimpleNamespace(session=None, msgpack=False)
+
+_post = SimpleNamespace(queue=None, thread=None)
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK_MIME = 'application/msgpack'
+
+_json_decoder = json.JSONDecoder(object_pairs_hook=OrderedDict)
+
 config = SimpleNamespace(db=None,
                          db_pool_size=10,
+                         db_ping_interval=60,
                          thread_pool_size=30,
                          keep_integrity=True,
                          lazy_exchange=True,
                          full_transaction_update=True,
                          rate_allow_reverse=True,
                          rate_allow_cross=True,
+                         rate_cross_max_hops=None,
                          base_asset='USD',
                          api_uri=None,
                          api_key=None,
                          api_timeout=5,
+                         api_pool_size=10,
+                         post_delay=0.005,
+                         post_batch_size=1000,
                          multiplier=None,
                          redis_host=None,
                          redis_port=6379,
                          redis_db=0,
                          redis_timeout=5,
                          redis_blocking_timeout=5,
+                         lock_timeout=None,
+                         lock_mode=None,
+                         sqlite_wal=False,
                          restrict_deletion=None,
                          date_format='%Y-%m-%d %H:%M:%S %Z',
                          rate_cache_ttl=None,
+                         balance_checkpoint=None,
+                         rate_index=False,
+                         account_cache_ttl=None,
                          insecure=False)
 
 _d = SimpleNamespace()
 
 lock_purge = threading.Lock()
+lock_rate_index = threading.Lock()
+lock_account_cache = threading.Lock()
 lock_account_token = threading.Lock()
+lock_api_session = threading.Lock()
 
 account_lockers = {}
 
+ACCOUNT_CACHE_CHANNEL = 'finac:account_cache'
+
 multiply_fields = {
     'asset_rate': ['value'],
     'account': ['max_overdraft', 'max_balance'],
@@ -176,44 +212,184 @@ def core_method(f):
 
     @wraps(f)
     def do(*args, **kwargs):
-        if config.api_uri is None:
+        b = getattr(_batch, 'b', None)
+        if b is not None:
+            fut = Future()
+            b.futures.append(fut)
+            if config.api_uri is None:
+                # nested core method calls are executed as usual
+                _batch.b = None
+                try:
+                    fut.set_result(f(*args, **kwargs))
+                except Exception as e:
+                    fut.set_exception(e)
+                finally:
+                    _batch.b = b
+            else:
+                b.calls.append((_api_payload(f.__name__, argspec, args,
+                                             kwargs), fut))
+            return fut
+        elif config.api_uri is None:
             return f(*args, **kwargs)
         else:
-            import requests
-            import uuid
-            import json
-            req_id = str(uuid.uuid4())
-            payload = {
-                'jsonrpc': '2.0',
-                'method': f.__name__,
-                'params': kwargs,
-                'id': req_id
-            }
-            if config.api_key is not None:
-                payload['params']['_k'] = config.api_key
-            for i, a in enumerate(args):
-                payload['params'][argspec.args[i]] = a
-            logger.debug('API request {} {} {}'.format(req_id,
+            payload = _api_payload(f.__name__, argspec, args, kwargs)
+            logger.debug('API request {} {} {}'.format(payload['id'],
                                                        payload['method'],
                                                        payload['params']))
-            r = requests.post(config.api_uri,
-                              json=payload,
-                              timeout=config.api_timeout)
-            if not r.ok:
-                raise RuntimeError('Finac server error: {}'.format(
-                    r.status_code))
-            result = json.JSONDecoder(object_pairs_hook=OrderedDict).decode(
-                r.text)
-            if 'error' in result:
-                raise _exceptions.get(result['error']['code'], RuntimeError)(
-                    result['error'].get('message'))
-            logger.debug('API response {} {}'.format(result['id'],
-                                                     result['result']))
-            return result['result']
+            return _api_result(_api_call(payload))
 
     return do
 
 
+def _api_payload(method, argspec, args, kwargs):
+    import uuid
+    payload = {
+        'jsonrpc': '2.0',
+        'method': method,
+        'params': kwargs,
+        'id': str(uuid.uuid4())
+    }
+    if config.api_key is not None:
+        payload['params']['_k'] = config.api_key
+    for i, a in enumerate(args):
+        payload['params'][argspec.args[i]] = a
+    return payload
+
+
+def _api_call(payload):
+    """
+    Call API server
+
+    If MessagePack module is installed, it is requested as the response
+    format. If the server responds with MessagePack, it is used for further
+    requests as well
+    """
+    kw = {}
+    if msgpack:
+        kw['headers'] = {
+            'Accept': '{}, application/json;q=0.9'.format(MSGPACK_MIME)
+        }
+        if _api.msgpack:
+            kw['data'] = msgpack_packb(payload)
+            kw['headers']['Content-Type'] = MSGPACK_MIME
+    if 'data' not in kw:
+        kw['json'] = payload
+    r = _api_session().post(config.api_uri, timeout=config.api_timeout, **kw)
+    if not r.ok:
+        raise RuntimeError('Finac server error: {}'.format(r.status_code))
+    if msgpack and r.headers.get('Content-Type') == MSGPACK_MIME:
+        _api.msgpack = True
+        return msgpack_unpackb(r.content)
+    else:
+        return _json_decoder.decode(r.text)
+
+
+def _msgpack_default(obj):
+    if isinstance(obj, datetime.datetime):
+        # naive datetimes are local
+        return msgpack.Timestamp.from_datetime(
+            obj if obj.tzinfo else obj.astimezone())
+    raise TypeError('Unable to serialize {}'.format(type(obj)))
+
+
+def _msgpack_naive(v):
+    return v.astimezone().replace(
+        tzinfo=None) if isinstance(v, datetime.datetime) else v
+
+
+def msgpack_packb(data, default=_msgpack_default):
+    """
+    Serialize data with MessagePack, datetimes are packed as timestamps
+    """
+    return msgpack.packb(data, default=default, datetime=True)
+
+
+def msgpack_unpackb(data):
+    """
+    Deserialize MessagePack data, timestamps are unpacked as naive local
+    datetimes, maps as ordered dicts
+    """
+    return msgpack.unpackb(
+        data,
+        timestamp=3,
+        object_pairs_hook=lambda pairs: OrderedDict(
+            (k, _msgpack_naive(v)) for k, v in pairs),
+        list_hook=lambda items: [_msgpack_naive(v) for v in items])
+
+
+def _api_result(result):
+    if 'error' in result:
+        raise _exceptions.get(result['error']['code'],
+                              RuntimeError)(result['error'].get('message'))
+    logger.debug('API response {} {}'.format(result['id'], result['result']))
+    return result['result']
+
+
+@contextmanager
+def batch():
+    """
+    Collect API calls and send them to the server as a single batch request
+
+    Inside the context, core functions return futures
+    (concurrent.futures.Future), the batch is sent on exit. If no API is used,
+    functions are called immediately and completed futures are returned
+
+    Usage:
+
+        with finac.batch() as b:
+            balances = {a: finac.account_balance(a) for a in accounts}
+        balances = {a: v.result() for a, v in balances.items()}
+
+    Returns:
+        list of futures, in order of calls
+    """
+    if getattr(_batch, 'b', None) is not None:
+        raise RuntimeError('Batch is already started')
+    b = SimpleNamespace(calls=[], futures=[])
+    _batch.b = b
+    try:
+        yield b.futures
+    except:
+        for fut in b.futures:
+            fut.cancel()
+        raise
+    finally:
+        _batch.b = None
+    if b.calls:
+        logger.debug('API batch request, {} calls'.format(len(b.calls)))
+        try:
+            results = {r['id']: r for r in _api_call([c[0] for c in b.calls])}
+        except Exception as e:
+            for _, fut in b.calls:
+                fut.set_exception(e)
+            raise
+        for payload, fut in b.calls:
+            try:
+                fut.set_result(_api_result(results[payload['id']]))
+            except Exception as e:
+                fut.set_exception(e)
+
+
+def _api_session():
+    """
+    Get HTTP session for API calls
+
+    The session is shared between threads, keep-alive connections are pooled
+    """
+    if _api.session is None:
+        with lock_api_session:
+            if _api.session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1,
+                                      pool_maxsize=config.api_pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _api.session = session
+    return _api.session
+
+
 def deletion_method(f):
 
     @wraps(f)
@@ -240,6 +416,14 @@ def format_date(d, force=False):
                 parse_date(d, return_timestamp=False), config.date_format)
 
 
+def _naive_date(d):
+    """
+    Convert timezone-aware date to the naive local one, to compare it with
+    stored dates
+    """
+    return d.astimezone().replace(tzinfo=None) if d.tzinfo else d
+
+
 def preload():
     """
     Preload static data
@@ -449,13 +633,26 @@ _exceptions = {
 
 
 class AccountLocker:
+    """
+    Account lock
+
+    If Redis is not used, waiters are queued and get the lock in FIFO order
+    """
 
     def __init__(self):
         self.token = None
         self.counter = 0
         self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._queue = deque()
+        self.waits = 0
+        self.wait_time = 0
 
-    def acquire(self, token=None, account=None):
+    @property
+    def waiters(self):
+        return len(self._queue)
+
+    def acquire(self, token=None, account=None, blocking=True, timeout=None):
         if token:
             with self._lock:
                 if token == self.token:
@@ -463,22 +660,61 @@ class AccountLocker:
                     return token
         if _db.redis_conn:
             with self._lock:
-                self.token = _db.redis_conn.lock(
+                lock = _db.redis_conn.lock(
                     account,
-                    blocking_timeout=config.redis_blocking_timeout,
+                    blocking_timeout=config.redis_blocking_timeout
+                    if timeout is None else timeout,
                     thread_local=False)
-                if not self.token.acquire():
+                if not lock.acquire(blocking=blocking):
+                    if not blocking:
+                        return False
                     raise RuntimeError('Unable to acquire account lock')
+                self.token = lock
                 self.counter = 1
                 return self.token
         else:
-            while True:
-                with self._lock:
-                    if not self.counter:
-                        self.token = gen_random_str() if not token else token
-                        self.counter = 1
-                        return self.token
-                time.sleep(LOCK_DELAY)
+            if timeout is None:
+                timeout = config.lock_timeout
+            with self._cond:
+                if not self.counter and not self._queue:
+                    return self._set_token(token)
+                elif not blocking:
+                    return False
+                ticket = object()
+                self._queue.append(ticket)
+                t_start = time.perf_counter()
+                try:
+                    while self.counter or self._queue[0] is not ticket:
+                        if timeout is None:
+                            self._cond.wait()
+                        else:
+                            remaining = timeout - (time.perf_counter() -
+                                                   t_start)
+                            if remaining <= 0:
+                                raise RuntimeError(
+                                    'Unable to acquire account lock')
+                            self._cond.wait(remaining)
+                    return self._set_token(token)
+                finally:
+                    self._queue.remove(ticket)
+                    self.waits += 1
+                    self.wait_time += time.perf_counter() - t_start
+                    # the next waiter may be able to get the lock now
+                    self._cond.notify_all()
+
+    def _set_token(self, token):
+        self.token = gen_random_str() if not token else token
+        self.counter = 1
+        return self.token
+
+    def set_redis_lock(self, lock):
+        """
+        Set Redis lock, acquired outside
+        """
+        with self._lock:
+            self.token = lock
+            self.counter = 1
+            return lock
 
     def release(self, token):
         with self._lock:
@@ -491,6 +727,14 @@ class AccountLocker:
                 if _db.redis_conn:
                     self.token.release()
                 self.token = None
+                self._cond.notify_all()
+
+
+# SQLite WAL mode settings
+SQLITE_WAL_PRAGMAS = [
+    'journal_mode=WAL', 'synchronous=NORMAL', 'mmap_size=268435456',
+    'cache_size=-65536'
+]
 
 
 def get_db_engine(db_uri):
@@ -498,35 +742,263 @@ def get_db_engine(db_uri):
     def _fk_pragma_on_connect(dbapi_con, con_record):
         dbapi_con.execute('pragma foreign_keys=ON')
 
+    def _autocommit_on_connect(dbapi_con, con_record):
+        # let SQLAlchemy emit BEGIN, instead of the driver
+        dbapi_con.isolation_level = None
+
+    def _begin(conn):
+        # as the driver does, BEGIN is emitted before the first write only:
+        # the database is locked after the accounts of the write are. A
+        # deferred transaction can not upgrade its read lock, so BEGIN
+        # IMMEDIATE is used to wait for the write lock instead of failing
+        conn.info['sqlite_begin'] = True
+
+    def _begin_flush(conn, *args):
+        if conn.info.pop('sqlite_begin', False):
+            conn.exec_driver_sql('BEGIN IMMEDIATE')
+
+    def _begin_on_write(conn, cursor, statement, parameters, context,
+                        executemany):
+        if conn.info.get('sqlite_begin') and statement.lstrip()[:6].lower(
+        ) in ('insert', 'update', 'delete'):
+            del conn.info['sqlite_begin']
+            cursor.execute('BEGIN IMMEDIATE')
+
+    def _begin_discard(conn, *args):
+        conn.info.pop('sqlite_begin', None)
+
+    def _wal_on_connect(dbapi_con, con_record):
+        for pragma in SQLITE_WAL_PRAGMAS:
+            dbapi_con.execute('pragma ' + pragma)
+
+    def _writer_begin(conn):
+        # the process has a single writer, other threads wait for the lock
+        # instead of SQLite busy waits
+        _d.sqlite_writer.acquire()
+        conn.info['sqlite_writer'] = True
+        try:
+            conn.exec_driver_sql('BEGIN IMMEDIATE')
+        except:
+            _writer_end(conn)
+            raise
+
+    def _writer_end(conn):
+        if conn.info.pop('sqlite_writer', False):
+            _d.sqlite_writer.release()
+
+    def _autocommit_write_start(conn, cursor, statement, parameters, context,
+                                executemany):
+        # writes outside of DB transactions are serialized as well
+        if not conn.in_transaction() and statement.lstrip()[:6].lower() in (
+                'insert', 'update', 'delete'):
+            _d.sqlite_writer.acquire()
+            conn.info['sqlite_autocommit_writer'] = True
+
+    def _autocommit_write_end(conn, *args):
+        if conn.info.pop('sqlite_autocommit_writer', False):
+            _d.sqlite_writer.release()
+
+    def _autocommit_write_error(context):
+        if context.connection is not None:
+            _autocommit_write_end(context.connection)
+
     if db_uri.startswith('sqlite:///'):
         engine = sa.create_engine(db_uri)
         sa.event.listen(engine, 'connect', _fk_pragma_on_connect)
+        # required for savepoints
+        sa.event.listen(engine, 'connect', _autocommit_on_connect)
+        if config.sqlite_wal:
+            sa.event.listen(engine, 'connect', _wal_on_connect)
+        if config.sqlite_wal or config.lock_mode == 'db':
+            # transactions lock the database for writing
+            sa.event.listen(engine, 'begin', _writer_begin)
+            sa.event.listen(engine, 'commit', _writer_end)
+            sa.event.listen(engine, 'rollback', _writer_end)
+            sa.event.listen(engine, 'before_cursor_execute',
+                            _autocommit_write_start)
+            sa.event.listen(engine, 'after_cursor_execute',
+                            _autocommit_write_end)
+            sa.event.listen(engine, 'handle_error', _autocommit_write_error)
+        else:
+            sa.event.listen(engine, 'begin', _begin)
+            sa.event.listen(engine, 'savepoint', _begin_flush)
+            sa.event.listen(engine, 'before_cursor_execute', _begin_on_write)
+            sa.event.listen(engine, 'commit', _begin_discard)
+            sa.event.listen(engine, 'rollback', _begin_discard)
         return engine
     else:
         return sa.create_engine(db_uri,
+                                pool_pre_ping=True,
                                 pool_size=config.db_pool_size,
                                 max_overflow=config.db_pool_size * 2)
 
 
 def get_db():
-    try:
-        g.db.execute('select 1')
-        return g.db
-    except AttributeError:
-        pass
-    except:
+    db = getattr(g, 'db', None)
+    if db is not None:
+        now = time.monotonic()
+        if db.closed or db.invalidated:
+            # the connection is invalidated on disconnect errors
+            pass
+        elif db.in_transaction() or config.db_ping_interval is None or \
+                now - g.db_used < config.db_ping_interval:
+            g.db_used = now
+            return db
+        else:
+            try:
+                db.execute('select 1')
+                g.db_used = now
+                return db
+            except:
+                pass
         try:
-            g.db.close()
+            db.close()
         except:
             pass
     if not _db.engine:
         raise RuntimeError('finac not initialized')
     g.db = _db.engine.connect()
+    g.db_used = time.monotonic()
     return g.db
 
 
-def spawn(*args, **kwargs):
-    return _d.pool.submit(*args, **kwargs)
+@contextmanager
+def _db_transaction(db):
+    """
+    Run block in DB transaction, join the current one if already started
+    """
+    if db.in_transaction():
+        try:
+            yield db
+        except:
+            # the outer transaction should be rolled back
+            g.db_rollback = True
+            raise
+    else:
+        dbt = db.begin()
+        try:
+            yield db
+            dbt.commit()
+        except:
+            dbt.rollback()
+            _cache_reset()
+            raise
+
+
+def spawn(fn, *args, **kwargs):
+    """
+    Run function in the thread pool, in own DB session
+    """
+
+    def _call():
+        with session():
+            return fn(*args, **kwargs)
+
+    return _d.pool.submit(_call)
+
+
+@contextmanager
+def session(transaction=False):
+    """
+    Unit of work: DB connection of the current thread is returned back to the
+    pool on exit, instead of being kept by the thread
+
+    Sessions can be nested, the connection is returned by the outer one. If
+    no API is used, the DB connection is yielded
+
+    Usage:
+
+        with finac.session(transaction=True):
+            finac.transaction_move(dt='a', ct='b', amount=10)
+            finac.transaction_move(dt='b', ct='c', amount=10)
+
+    Args:
+        transaction: run the block in a single DB transaction, which is
+            committed on exit or rolled back if an exception is raised
+    """
+    if config.api_uri is not None:
+        yield None
+        return
+    depth = getattr(g, 'session_depth', 0)
+    g.session_depth = depth + 1
+    try:
+        db = get_db()
+        dbt = db.begin() if transaction and not db.in_transaction() else None
+        try:
+            yield db
+        except:
+            if dbt and dbt.is_active:
+                dbt.rollback()
+                _cache_reset()
+            raise
+        if dbt:
+            dbt.commit()
+    finally:
+        g.session_depth = depth
+        db = getattr(g, 'db', None)
+        if not depth and db is not None and not db.in_transaction():
+            g.db = None
+            db.close()
+
+
+@contextmanager
+def atomic():
+    """
+    Run core functions of the block in a single DB transaction
+
+    The transaction is committed on exit or rolled back if an exception is
+    raised. Blocks can be nested, nested blocks use savepoints, so an
+    exception, caught outside of a nested block, rolls back its changes only.
+    Accounts, locked inside the block, are kept locked until the outer block
+    is finished
+
+    Usage:
+
+        with finac.atomic():
+            finac.transaction_move(dt='a', ct='b', amount=10)
+            finac.transaction_move(dt='b', ct='c', amount=10)
+    """
+    if config.api_uri is not None:
+        raise RuntimeError('Atomic blocks are not supported for remote API')
+    st = getattr(g, 'atomic', None)
+    owner = st is None
+    with session():
+        db = get_db()
+        if owner:
+            st = SimpleNamespace(tokens={})
+            g.atomic = st
+        try:
+            dbt = db.begin_nested() if db.in_transaction() else db.begin()
+            try:
+                yield
+            except:
+                if dbt.is_active:
+                    dbt.rollback()
+                    _cache_reset()
+                raise
+            dbt.commit()
+        finally:
+            if owner:
+                g.atomic = None
+                account_unlock_many(st.tokens)
+
+
+def _atomic_token(account):
+    """
+    Get lock token of the account, locked by the current atomic block
+    """
+    st = getattr(g, 'atomic', None)
+    return st.tokens.get(account) if st else None
+
+
+def _atomic_hold(account, token):
+    """
+    Keep the account locked until the current atomic block is finished
+    """
+    st = getattr(g, 'atomic', None)
+    if st and token and account not in st.tokens:
+        _writer_acquire()
+        st.tokens[account] = _account_locker(account).acquire(token, account)
 
 
 def init(db=None, **kwargs):
@@ -536,6 +1008,10 @@ def init(db=None, **kwargs):
     Args:
         db: SQLAlchemy DB URI or sqlite file name
         db_pool_size: DB pool size (default: 10)
+        db_ping_interval: check DB connection, which has been idle for more
+            than the specified number of seconds, with a ping query before
+            use (default: 60, 0 - check before each use, None - never).
+            Connections, broken by disconnect errors, are always re-opened
         thread_pool_size: thread pool size for internal processes (default: 30)
         keep_integrity: finac should keep database integrity (lock accounts,
             watch overdrafts, overlimits etc. Default is True
@@ -545,8 +1021,15 @@ def init(db=None, **kwargs):
             "EUR/USD" pair exists but no USD/EUR, use 1 / "EUR/USD"
         rate_allow_cross: if exchange rate is not found, allow finac to look
             for the nearest cross-asset rate
+        rate_cross_max_hops: max conversions allowed for cross-asset rates
+            (default: unlimited)
         rate_cache_size: set rate cache size (default: 1024)
         rate_cache_ttl: set rate cache ttl (default: 5 sec)
+        account_cache_size: set account info cache size (default: 1024)
+        account_cache_ttl: set account info cache ttl (default: 5 sec)
+        rate_index: keep in-memory timelines of asset rates and look up
+            historical rates there instead of querying the database. Rate
+            timelines are reloaded from the database after rate_cache_ttl
         full_transaction_update: allow updating transaction date and amount
         base_asset: default base asset. Default is "USD"
         date_format: default date format in statements
@@ -557,18 +1040,51 @@ def init(db=None, **kwargs):
         redis_db: Redis database (default: 0)
         redis_timeout: Redis server timeout
         redis_blocking_timeout: Redis lock acquisition timeout
+        lock_timeout: account lock acquisition timeout, if Redis is not used
+            (default: wait forever)
+        lock_mode: set to "db" to lock accounts with database locks
+            (PostgreSQL advisory locks, SELECT ... FOR UPDATE for other
+            databases, BEGIN IMMEDIATE for SQLite) instead of in-process or
+            Redis locks. Account lock starts a database transaction, which is
+            committed when the last account is unlocked. Balance checkpoints
+            are not created in this mode. Locks belong to the DB transaction
+            of the current thread, so they can not be acquired and released
+            by separate API requests (such calls are rejected by the server)
+        sqlite_wal: use SQLite WAL journal mode with tuned pragmas
+            (SQLITE_WAL_PRAGMAS). Reads don't wait for writes, DB transactions
+            are serialized with a process-wide writer lock and started with
+            BEGIN IMMEDIATE. Account locks are acquired after the writer
+            lock and must be released by the same thread, so they can not be
+            kept between API requests. Default: False
+        api_pool_size: max keep-alive connections to API server (default: 10)
+        post_delay: time the posting queue collects transactions for a single
+            commit (default: 0.005 sec)
+        post_batch_size: max transactions committed by the posting queue at
+            once (default: 1000)
         custom_account_types: custom account types dict
+        balance_checkpoint: store historical balance checkpoints ("daily" or
+            "monthly") to speed up account_balance and account_list for
+            past dates. Must be the same for all processes which work with
+            the database
 
     Note: if Redis server is specified, Finac will use it for integrity locking
           (if enabled). In this case, lock tokens become Redis lock objects.
+          Account info cache changes are also announced to other processes
+          via Redis.
     """
     rate_cache_ttl = 5
     rate_cache_size = 1024
+    account_cache_ttl = 5
+    account_cache_size = 1024
     for k, v in kwargs.items():
         if k == 'rate_cache_ttl':
             rate_cache_ttl = v
         elif k == 'rate_cache_size':
             rate_cache_size = v
+        elif k == 'account_cache_ttl':
+            account_cache_ttl = v
+        elif k == 'account_cache_size':
+            account_cache_size = v
         elif k == 'custom_account_types':
             for act in v:
                 try:
@@ -604,9 +1120,21 @@ def init(db=None, **kwargs):
     _cache.rate = TTLCache(maxsize=rate_cache_size, ttl=rate_cache_ttl)
     _cache.rate_list = TTLCache(maxsize=rate_cache_size, ttl=rate_cache_ttl)
     config.rate_cache_ttl = rate_cache_ttl
+    _cache.account = TTLCache(maxsize=account_cache_size, ttl=account_cache_ttl)
+    _cache.asset = TTLCache(maxsize=account_cache_size, ttl=account_cache_ttl)
+    config.account_cache_ttl = account_cache_ttl
+    _post_stop()
     _d.pool = ThreadPoolExecutor(max_workers=config.thread_pool_size)
+    _d.sqlite_writer = threading.RLock()
+    with lock_api_session:
+        if _api.session is not None:
+            _api.session.close()
+            _api.session = None
+        _api.msgpack = False
     if config.multiplier:
         config.multiplier = float(config.multiplier)
+    if config.lock_mode not in (None, 'db'):
+        raise RuntimeError('Invalid lock mode: {}'.format(config.lock_mode))
     if db is not None:
         config.db = db
         db_uri = db
@@ -616,12 +1144,20 @@ def init(db=None, **kwargs):
         _db.use_lastrowid = db_uri.startswith('sqlite') or db_uri.startswith(
             'mysql')
         init_db(_db.engine)
+        _account_balance_init()
+        if config.balance_checkpoint not in (None, 'daily', 'monthly'):
+            raise RuntimeError('Invalid balance checkpoint interval: {}'.format(
+                config.balance_checkpoint))
     if config.redis_host is not None:
         import redis
         _db.redis_conn = redis.Redis(host=config.redis_host,
                                      port=config.redis_port,
                                      db=config.redis_db,
                                      socket_timeout=config.redis_timeout)
+        pubsub = _db.redis_conn.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{ACCOUNT_CACHE_CHANNEL: _account_cache_listener})
+        _d.redis_pubsub_thread = pubsub.run_in_thread(sleep_time=1,
+                                                      daemon=True)
 
 
 @core_method
@@ -777,6 +1313,9 @@ def asset_delete(asset):
     delete from asset where code=:code"""), dict(code=asset.upper())).rowcount:
         logger.error('Asset {} not found'.format(asset.upper()))
         raise ResourceNotFound
+    with lock_rate_index:
+        _rate_index.clear()
+    _account_cache_invalidate()
 
 
 @core_method
@@ -811,18 +1350,117 @@ def asset_set_rate(asset_from, asset_to=None, value=None, date=None):
     get_db().execute(
         sql("""
     insert into asset_rate (asset_from_id, asset_to_id, d, value)
-    values
-    (
-        (select id from asset where code=:f),
-        (select id from asset where code=:t),
-        :d,
-        :value
-    )
+    values (:f, :t, :d, :value)
     """),
-        dict(f=asset_from.upper(),
-             t=asset_to.upper(),
+        dict(f=_asset_id(asset_from),
+             t=_asset_id(asset_to),
              d=date,
              value=_multiply(value)))
+    _rate_index_set(asset_from.upper(), asset_to.upper(), date,
+                    _demultiply(_multiply(value)))
+    # rate graphs (and conversion vectors) are rebuilt on the next request
+    _cache.rate_list.clear()
+
+
+@core_method
+def asset_set_rates_bulk(rates, chunk_size=10000):
+    """
+    Set multiple asset rates at once
+
+    Rates already set for the same asset pairs and dates are replaced. All
+    rates are set in a single database transaction
+
+    Args:
+        rates: iterable of (pair, date, value), pair is "FROM/TO" string
+        chunk_size: rows per executemany call
+
+    Returns:
+        number of rates set
+    """
+    count = 0
+    with _db_transaction(get_db()) as db:
+        chunk = {}
+
+        def _flush():
+            rows = list(chunk.values())
+            db.execute(
+                sql("""
+            delete from asset_rate where
+                asset_from_id=:f and asset_to_id=:t and d=:d"""), rows)
+            db.execute(
+                sql("""
+            insert into asset_rate (asset_from_id, asset_to_id, d, value)
+            values (:f, :t, :d, :value)"""), rows)
+            chunk.clear()
+
+        for pair, date, value in rates:
+            asset_from, asset_to = pair.split('/')
+            f = _asset_id(asset_from)
+            t = _asset_id(asset_to)
+            date = parse_date(date, return_timestamp=False)
+            chunk[(f, t, date)] = dict(f=f,
+                                       t=t,
+                                       d=date,
+                                       value=_multiply(parse_number(value)))
+            count += 1
+            if len(chunk) >= chunk_size:
+                _flush()
+        if chunk:
+            _flush()
+    logger.info('{} asset rates set'.format(count))
+    _cache.rate.clear()
+    _cache.rate_list.clear()
+    with lock_rate_index:
+        _rate_index.clear()
+    return count
+
+
+def asset_import_rates(fname, format=None, chunk_size=10000):
+    """
+    Import asset rates from a file
+
+    The file is read as a stream, rates are set with asset_set_rates_bulk,
+    each chunk in a single database transaction
+
+    Args:
+        fname: file name
+        format: csv or jsonl (default: guess from the file extension). CSV
+            files should have a header with "pair" (or "asset_from" and
+            "asset_to"), "date" and "value" columns. JSONL rows are objects
+            with the same fields or [pair, date, value] lists
+        chunk_size: rates per database transaction
+
+    Returns:
+        number of rates set
+    """
+    import csv
+
+    def _row(r):
+        if isinstance(r, (list, tuple)):
+            return r
+        pair = r['pair'] if 'pair' in r else '{}/{}'.format(
+            r['asset_from'], r['asset_to'])
+        return (pair, r['date'], r['value'])
+
+    if format is None:
+        format = os.path.splitext(fname)[1][1:].lower()
+    count = 0
+    chunk = []
+    with open(fname) as fh:
+        if format == 'csv':
+            rows = csv.DictReader(fh)
+        elif format == 'jsonl':
+            rows = (json.loads(line) for line in fh if line.strip())
+        else:
+            raise ValueError('Unsupported format: {}'.format(format))
+        for r in rows:
+            chunk.append(_row(r))
+            if len(chunk) >= chunk_size:
+                count += asset_set_rates_bulk(chunk)
+                chunk = []
+        if chunk:
+            count += asset_set_rates_bulk(chunk)
+    return count
 
 
 @deletion_method
@@ -842,14 +1480,71 @@ def asset_delete_rate(asset_from, asset_to=None, date=None):
     if not get_db().execute(
             sql("""
     delete from asset_rate where
-        asset_from_id=(select id from asset where code=:f)
-        and
-        asset_to_id=(select id from asset where code=:t)
-        and d=:d
-        """), dict(f=asset_from.upper(), t=asset_to.upper(), d=date)).rowcount:
+        asset_from_id=:f and asset_to_id=:t and d=:d
+        """), dict(f=_asset_id(asset_from), t=_asset_id(asset_to),
+                   d=date)).rowcount:
         logger.error('Asset rate {}/{} for {} not found'.format(
             asset_from.upper(), asset_to.upper(), format_date(date)))
         raise ResourceNotFound
+    _rate_index_set(asset_from.upper(), asset_to.upper(), date, None)
+    _cache.rate_list.clear()
+
+
+def _rate_index_get(asset_from, asset_to):
+    """
+    Get rate timeline for the asset pair, load it from the database if
+    missing or expired
+    """
+    with lock_rate_index:
+        try:
+            timeline = _rate_index[(asset_from, asset_to)]
+            if timeline.loaded > time.time() - config.rate_cache_ttl:
+                return timeline
+        except KeyError:
+            pass
+    r = get_db().execute(
+        sql("""
+        select d, value from asset_rate
+            join asset as cfrom on asset_from_id=cfrom.id
+            join asset as cto on asset_to_id=cto.id
+        where cfrom.code = :f and cto.code = :t
+        order by d
+        """).columns(d=sa.DateTime, value=sa.Float),
+        dict(f=asset_from, t=asset_to))
+    timeline = SimpleNamespace(times=[], values=[], loaded=time.time())
+    for d in r:
+        timeline.times.append(
+            d.d.replace(tzinfo=None) if d.d.tzinfo else d.d)
+        timeline.values.append(_demultiply(d.value))
+    with lock_rate_index:
+        _rate_index[(asset_from, asset_to)] = timeline
+    return timeline
+
+
+def _rate_index_lookup(asset_from, asset_to, d):
+    """
+    Get asset rate for the date from the rate timeline
+    """
+    timeline = _rate_index_get(asset_from, asset_to)
+    i = bisect_right(timeline.times, _naive_date(d))
+    return timeline.values[i - 1] if i else None
+
+
+def _rate_index_set(asset_from, asset_to, d, value):
+    """
+    Update loaded rate timeline (value=None to delete the rate)
+    """
+    with lock_rate_index:
+        timeline = _rate_index.get((asset_from, asset_to))
+        if timeline:
+            d = _naive_date(d)
+            i = bisect_left(timeline.times, d)
+            if i < len(timeline.times) and timeline.times[i] == d:
+                del timeline.times[i]
+                del timeline.values[i]
+            if value is not None:
+                timeline.times.insert(i, d)
+                timeline.values.insert(i, value)
 
 
 def _parse_asset_pair(asset_from, asset_to):
@@ -881,6 +1576,215 @@ def asset_rate(asset_from=None,
     return (f'{asset_from}/{asset_to}', result) if return_pair else result
 
 
+def _rate_graph(d):
+    """
+    Get graph of asset rates for the specified date
+
+    The graph is built from the rate list once per rate list cache key
+
+    Returns:
+        namespace with fields:
+            direct: dict (asset_from, asset_to): value
+            rates: dict (asset_from, asset_to): value, including reverse rates
+            graph: dict asset: list of assets it can be converted to
+            paths: memoized conversion paths
+            vectors: memoized conversion vectors
+    """
+    key = _format_ttlcache_key(d, config.rate_cache_ttl)
+    try:
+        return _cache.rate_list[key]
+    except _CacheRateListKeyError:
+        pass
+    rate_graph = _rate_graph_build({(r['asset_from'], r['asset_to']): r['value']
+                                    for r in asset_list_rates(end=d)})
+    _cache.rate_list[key] = rate_graph
+    return rate_graph
+
+
+def _rate_graph_build(direct):
+    """
+    Build graph of asset rates from dict (asset_from, asset_to): value
+    """
+    rate_graph = SimpleNamespace(direct=direct,
+                                 rates=direct.copy(),
+                                 graph={},
+                                 paths={},
+                                 vectors={})
+    rates = rate_graph.rates
+    graph = rate_graph.graph
+    for k in direct:
+        graph.setdefault(k[0], []).append(k[1])
+    for k, v in direct.items():
+        if (k[1], k[0]) not in rates:
+            try:
+                rates[(k[1], k[0])] = 1 / v
+                graph.setdefault(k[1], []).append(k[0])
+            except ZeroDivisionError:
+                pass
+    return rate_graph
+
+
+def _rate_graphs(times):
+    """
+    Get graphs of asset rates for the sorted list of dates
+
+    Rates are fetched with a single ordered query, graphs are rebuilt only
+    for dates the rates are changed since the previous one
+
+    Returns:
+        list of rate graphs (see _rate_graph), one per date
+    """
+    result = []
+    if not times:
+        return result
+    r = get_db().execute(
+        sql("""
+        select cf.code as asset_from, ct.code as asset_to, d, value
+        from asset_rate
+            join asset as cf on asset_from_id = cf.id
+            join asset as ct on asset_to_id = ct.id
+        where d <= :end order by d""").columns(asset_from=sa.String,
+                                                asset_to=sa.String,
+                                                d=sa.DateTime),
+        end=_naive_date(times[-1]))
+    direct = {}
+    rate_graph = None
+    row = r.fetchone()
+    for t in times:
+        t = _naive_date(t)
+        changed = rate_graph is None
+        while row is not None:
+            # stored timezone is the session one
+            d = row.d.replace(tzinfo=None) if row.d.tzinfo else row.d
+            if d > t:
+                break
+            direct[(row.asset_from, row.asset_to)] = _demultiply(row.value)
+            changed = True
+            row = r.fetchone()
+        if changed:
+            rate_graph = _rate_graph_build(direct.copy())
+        result.append(rate_graph)
+    r.close()
+    return result
+
+
+def _rate_graph_path(rate_graph, asset_from, asset_to):
+    """
+    Find the shortest (fewest hops) conversion path in the rate graph
+
+    Returns:
+        list of assets or None if no path found
+    """
+    max_hops = config.rate_cross_max_hops
+    try:
+        return rate_graph.paths[(asset_from, asset_to, max_hops)]
+    except KeyError:
+        pass
+    graph = rate_graph.graph
+    parents = {asset_from: None}
+    level = [asset_from]
+    path = None
+    hops = 0
+    while level and path is None and (max_hops is None or hops < max_hops):
+        hops += 1
+        next_level = []
+        for node in level:
+            for n in graph.get(node, ()):
+                if n not in parents:
+                    parents[n] = node
+                    if n == asset_to:
+                        path = [n]
+                        while parents[path[-1]] is not None:
+                            path.append(parents[path[-1]])
+                        path.reverse()
+                        break
+                    next_level.append(n)
+            if path:
+                break
+        level = next_level
+    rate_graph.paths[(asset_from, asset_to, max_hops)] = path
+    return path
+
+
+@core_method
+def asset_rate_vector(base=None, date=None, _time_ms=False):
+    """
+    Get rates of all assets to the base asset
+
+    Rates are calculated in a single pass over the rate list for the date
+    and follow the same rules as asset_rate (direct, reverse and cross
+    rates)
+
+    Args:
+        base: base asset (if not specified, config.base_asset is used)
+        date: rate date (default: now)
+
+    Returns:
+        dict asset: rate. Assets, which have no rate for the base asset,
+        are not included
+    """
+    return _asset_rate_vector(base=base, date=date, _time_ms=_time_ms).copy()
+
+
+def _asset_rate_vector(base=None, date=None, _time_ms=False):
+    if base is None:
+        base = config.base_asset
+    if date is None:
+        date = parse_date(return_timestamp=False)
+    else:
+        date = parse_date(date, return_timestamp=False, ms=_time_ms)
+    return _rate_graph_vector(_rate_graph(date), base.upper())
+
+
+def _rate_graph_vector(rate_graph, base):
+    """
+    Get rates of all assets to the base asset from the rate graph
+    """
+    vkey = (base, config.rate_allow_reverse, config.rate_allow_cross,
+            config.rate_cross_max_hops)
+    try:
+        return rate_graph.vectors[vkey]
+    except KeyError:
+        pass
+    vector = {base: 1}
+    for asset in rate_graph.graph:
+        if asset == base:
+            continue
+        value = rate_graph.direct.get((asset, base))
+        if not value and config.rate_allow_reverse is True:
+            value = rate_graph.direct.get((base, asset))
+            if value:
+                value = 1 / value
+            elif config.rate_allow_cross:
+                path = _rate_graph_path(rate_graph, asset, base)
+                if path:
+                    value = 1
+                    for i in range(0, len(path) - 1):
+                        value *= rate_graph.rates[path[i], path[i + 1]]
+        if value:
+            vector[asset] = value
+    rate_graph.vectors[vkey] = vector
+    return vector
+
+
+def _asset_rate_base(asset, base, date=None, _time_ms=False, rate_graph=None):
+    """
+    Get asset rate to the base asset from the conversion vector
+
+    If rate graph is specified, it is used instead of the graph for the date
+    """
+    try:
+        if rate_graph is not None:
+            return _rate_graph_vector(rate_graph, base.upper())[asset.upper()]
+        return _asset_rate_vector(base=base, date=date,
+                                  _time_ms=_time_ms)[asset.upper()]
+    except KeyError:
+        raise RateNotFound('{}/{} for {} (base asset: {})'.format(
+            asset.upper(), base.upper(),
+            format_date(parse_date(date, return_timestamp=False)),
+            config.base_asset))
+
+
 def _asset_rate_lookup(asset_from, asset_to=None, date=None, _time_ms=False):
     """
     Get asset rate for the specified date
@@ -899,6 +1803,8 @@ def _asset_rate_lookup(asset_from, asset_to=None, date=None, _time_ms=False):
     db = get_db()
 
     def _get_rate(cf, ct, d):
+        if config.rate_index:
+            return _rate_index_lookup(cf, ct, d)
         key = _format_ttlcache_key(d, config.rate_cache_ttl)
         try:
             return _cache.rate[(cf, ct, key)]
@@ -920,44 +1826,13 @@ def _asset_rate_lookup(asset_from, asset_to=None, date=None, _time_ms=False):
                 return None
 
     def _get_crossrate(asset_from, asset_to, d):
-
-        def _find_path(graph, start, end, path=[]):
-            path = path + [start]
-            if start == end:
-                return [path]
-            paths = []
-            for node in graph[start]:
-                if node not in path:
-                    paths += _find_path(graph, node, end, path)
-            return paths
-
-        graph = {}
-        rates = {}
-        key = _format_ttlcache_key(d, config.rate_cache_ttl)
-        try:
-            ratelist = _cache.rate_list[key]
-        except _CacheRateListKeyError:
-            ratelist = list(asset_list_rates(end=d))
-            _cache.rate_list[key] = ratelist
-        for r in ratelist:
-            rates[(r['asset_from'], r['asset_to'])] = r['value']
-            graph.setdefault(r['asset_from'], []).append(r['asset_to'])
-        for k, v in rates.copy().items():
-            if (k[1], k[0]) not in rates:
-                try:
-                    rates[(k[1], k[0])] = 1 / v
-                    graph.setdefault(k[1], []).append(k[0])
-                except ZeroDivisionError:
-                    pass
-        try:
-            path = min(_find_path(graph, asset_from, asset_to), key=len)
-        except (KeyError, ValueError):
-            return None
+        rate_graph = _rate_graph(d)
+        path = _rate_graph_path(rate_graph, asset_from, asset_to)
         if not path:
             return None
         rate = 1
         for i in range(0, len(path) - 1):
-            rate *= rates[path[i], path[i + 1]]
+            rate *= rate_graph.rates[path[i], path[i + 1]]
         return rate
 
     value = _get_rate(asset_from, asset_to, date)
@@ -1010,25 +1885,23 @@ def account_create(account,
     db = get_db()
     account = account.upper()
     asset = asset.upper()
-    if not db.execute(sql("""select id from asset where code=:code"""),
-                      dict(code=asset)).fetchone():
-        raise ResourceNotFound('asset {}'.format(asset))
-    dbt = db.begin()
+    asset_id = _asset_id(asset)
+    # savepoint in atomic blocks, the caller may handle the error
+    dbt = db.begin_nested() if db.in_transaction() else db.begin()
     logger.info('Creating account {}, asset: {}'.format(account, asset))
     try:
         r = db.execute(
             sql("""
         insert into account(code, note, tp, passive, asset_id, max_overdraft,
         max_balance) values
-        (:code, :note, :tp, :passive,
-            (select id from asset where code=:asset),
-            :max_overdraft, :max_balance) {}""".format(
+        (:code, :note, :tp, :passive, :asset_id, :max_overdraft,
+            :max_balance) {}""".format(
                 '' if _db.use_lastrowid else 'returning id')),
             dict(code=account,
                  note=note,
                  tp=tp_id,
                  passive=passive,
-                 asset=asset,
+                 asset_id=asset_id,
                  max_overdraft=_multiply(max_overdraft),
                  max_balance=_multiply(max_balance)))
         acc_id = r.lastrowid if _db.use_lastrowid else r.fetchone().id
@@ -1050,13 +1923,21 @@ def account_create(account,
                    account_id=acc_id,
                    d=datetime.datetime.fromtimestamp(0),
                    s=True)
+        db.execute(sql("""
+            INSERT INTO account_balance_current (account_id, balance)
+            VALUES (:account_id, 0)
+            """),
+                   account_id=acc_id)
         dbt.commit()
+        _account_cache_invalidate(account)
     except IntegrityError:
         dbt.rollback()
+        _cache_reset()
         raise ResourceAlreadyExists(account)
     except:
         logger.error('Unable to create account {}'.format(account))
         dbt.rollback()
+        _cache_reset()
         raise
 
 
@@ -1069,46 +1950,134 @@ def account_info(account=None):
     returned
     """
 
-    def _format_qdata(d):
+    if account is not None:
         return {
-            'code': d.account_code,
-            'note': d.note,
-            'type': ACCOUNT_TYPE_NAMES[d.tp],
-            'tp': d.tp,
-            'passive': d.passive,
-            'asset': d.asset,
-            'max_overdraft': _demultiply(d.max_overdraft),
-            'max_balance': _demultiply(d.max_balance)
+            k: v for k, v in _account_info_cached(account).items() if k != 'id'
         }
-
-    xkw = {}
-    if account is not None:
-        xkw['account'] = account.upper()
     r = get_db().execute(
         sql("""
             select account.code as account_code, account.note, account.tp,
             account.passive, asset.code as asset, max_overdraft, max_balance
             from account join
-            asset on account.asset_id = asset.id
-            {}""".format(
-            'where account.code = :account' if account is not None else '')),
-        **xkw)
-    if account is not None:
-        d = r.fetchone()
-        if not d:
-            raise ResourceNotFound
+            asset on account.asset_id = asset.id"""))
+
+    def _listgen():
+        while True:
+            d = r.fetchone()
+            if not d:
+                break
+            yield _format_account_info(d)
+
+    return _listgen()
+
+
+def _format_account_info(d):
+    return {
+        'code': d.account_code,
+        'note': d.note,
+        'type': ACCOUNT_TYPE_NAMES[d.tp],
+        'tp': d.tp,
+        'passive': d.passive,
+        'asset': d.asset,
+        'max_overdraft': _demultiply(d.max_overdraft),
+        'max_balance': _demultiply(d.max_balance)
+    }
+
+
+def _account_info_cached(account):
+    """
+    Get account info (plus account id) from the account cache
+
+    The returned dict is shared and should not be modified
+    """
+    account = account.upper()
+    with lock_account_cache:
+        try:
+            return _cache.account[account]
+        except KeyError:
+            pass
+    d = get_db().execute(sql("""
+        select account.id, account.code as account_code, account.note,
+        account.tp, account.passive, asset.code as asset, max_overdraft,
+        max_balance
+        from account join
+        asset on account.asset_id = asset.id
+        where account.code = :account"""),
+                         account=account).fetchone()
+    if not d:
+        raise ResourceNotFound('account {}'.format(account))
+    info = _format_account_info(d)
+    info['id'] = d.id
+    with lock_account_cache:
+        _cache.account[account] = info
+    return info
+
+
+def _account_id(account):
+    """
+    Resolve account code to account id
+    """
+    return _account_info_cached(account)['id']
+
+
+def _asset_id(asset):
+    """
+    Resolve asset code to asset id
+    """
+    asset = asset.upper()
+    with lock_account_cache:
+        try:
+            return _cache.asset[asset]
+        except KeyError:
+            pass
+    d = get_db().execute(sql('select id from asset where code=:code'),
+                         code=asset).fetchone()
+    if not d:
+        raise ResourceNotFound('asset {}'.format(asset))
+    with lock_account_cache:
+        _cache.asset[asset] = d.id
+    return d.id
+
+
+def _account_cache_invalidate(account=None):
+    """
+    Remove account from the account cache (all accounts and asset ids if not
+    specified)
+
+    If Redis is used, other processes are notified as well
+    """
+    account = account.upper() if account else None
+    _account_cache_drop(account)
+    if _db.redis_conn:
+        _db.redis_conn.publish(ACCOUNT_CACHE_CHANNEL, account or '*')
+
+
+def _account_cache_drop(account):
+    with lock_account_cache:
+        if account:
+            _cache.account.pop(account, None)
         else:
-            return _format_qdata(d)
-    else:
+            _cache.account.clear()
+            _cache.asset.clear()
 
-        def _listgen():
-            while True:
-                d = r.fetchone()
-                if not d:
-                    break
-                yield _format_qdata(d)
 
-        return _listgen()
+def _cache_reset():
+    """
+    Drop local caches, which may contain ids and rates of a rolled back DB
+    transaction
+    """
+    _account_cache_drop(None)
+    _asset_precision_cache.clear()
+    if _cache.rate is not None:
+        _cache.rate.clear()
+        _cache.rate_list.clear()
+    with lock_rate_index:
+        _rate_index.clear()
+
+
+def _account_cache_listener(message):
+    account = message['data'].decode()
+    _account_cache_drop(account if account != '*' else None)
 
 
 @core_method
@@ -1187,6 +2156,162 @@ def transaction_apply(fname):
     return result
 
 
+def transaction_import(fname,
+                       format=None,
+                       chunk_size=1000,
+                       start=0,
+                       state_file=None,
+                       on_progress=None,
+                       on_error=None):
+    """
+    Import transactions from a file
+
+    The file is read as a stream and transactions are posted in chunks, each
+    chunk in a single database transaction. If a chunk fails, its rows are
+    posted one by one to find the failed ones
+
+    Args:
+        fname: file name
+        format: csv, jsonl or yaml (default: guess from the file extension).
+            Rows are transaction_create (if "account" is specified) or
+            transaction_move arguments. YAML files have the same format as
+            for transaction_apply, CSV files should have a header. Targets
+            and exchange fields (target_ct, target_dt, xdt, rate) are not
+            supported, such rows are reported as failed
+        chunk_size: rows per database transaction
+        start: skip the specified number of rows
+        state_file: file to keep the number of processed rows in. If exists,
+            import is resumed after the last committed chunk. The file is
+            deleted when the import is finished. The file is updated after
+            the chunk is committed, so if the process is terminated between
+            the commit and the update, the chunk is imported again on resume
+            (also the rows of a failed chunk, which are committed one by
+            one). Use a smaller chunk size to reduce the duplicate window or
+            verify the transactions of the last chunk before resuming
+        on_progress: function, called after each chunk with the number of
+            processed rows
+        on_error: function, called for each failed row with the row number
+            (starting from 1), row and exception. If not specified, errors
+            are collected in the result
+
+    Returns:
+        dict with fields:
+            processed: number of processed rows (including skipped)
+            created: number of created transactions
+            errors: list of (row number, row, error message) tuples
+    """
+    if format is None:
+        format = os.path.splitext(fname)[1][1:].lower()
+        if format == 'yml':
+            format = 'yaml'
+    try:
+        reader = {
+            'csv': _import_rows_csv,
+            'jsonl': _import_rows_jsonl,
+            'yaml': _import_rows_yaml
+        }[format]
+    except KeyError:
+        raise ValueError('Unsupported format: {}'.format(format))
+    if state_file and os.path.exists(state_file):
+        with open(state_file) as fh:
+            start = int(fh.read().strip() or 0)
+    result = {'processed': start, 'created': 0, 'errors': []}
+
+    def _error(n, row, e):
+        msg = '{}: {}'.format(e.__class__.__name__,
+                              e) if str(e) else e.__class__.__name__
+        logger.error('Unable to import row {}: {}'.format(n, msg))
+        if on_error:
+            on_error(n, row, e)
+        else:
+            result['errors'].append((n, row, msg))
+
+    def _post(chunk):
+        moves = []
+        for n, row in chunk:
+            try:
+                moves.append((n, row, _transaction_create_as_move(row)
+                              if 'account' in row else row))
+            except Exception as e:
+                _error(n, row, e)
+        try:
+            ids = transaction_move_many([m[2] for m in moves])
+            result['created'] += len([i for i in ids if i is not None])
+        except Exception:
+            for n, row, m in moves:
+                try:
+                    if transaction_move_many([m])[0] is not None:
+                        result['created'] += 1
+                except Exception as e:
+                    _error(n, row, e)
+        result['processed'] += len(chunk)
+        if state_file:
+            with open(state_file + '.tmp', 'w') as fh:
+                fh.write(str(result['processed']))
+            os.replace(state_file + '.tmp', state_file)
+        if on_progress:
+            on_progress(result['processed'])
+
+    chunk = []
+    with open(fname) as fh:
+        for n, row in enumerate(reader(fh), start=1):
+            if n <= start:
+                continue
+            chunk.append((n, row))
+            if len(chunk) >= chunk_size:
+                _post(chunk)
+                chunk = []
+        if chunk:
+            _post(chunk)
+    if state_file and os.path.exists(state_file):
+        os.unlink(state_file)
+    return result
+
+
+def _import_rows_csv(fh):
+    import csv
+    for row in csv.DictReader(fh):
+        row = {k: v for k, v in row.items() if v not in ('', None)}
+        if 'mark_completed' in row:
+            row['mark_completed'] = val_to_boolean(row['mark_completed'])
+        yield row
+
+
+def _import_rows_jsonl(fh):
+    for line in fh:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def _import_rows_yaml(fh):
+    """
+    Read "transactions" list items one by one, without loading the whole
+    document
+    """
+    import yaml
+    loader = yaml.SafeLoader(fh)
+    try:
+        for ev in (yaml.StreamStartEvent, yaml.DocumentStartEvent,
+                   yaml.MappingStartEvent):
+            if not loader.check_event(ev):
+                raise ValueError('Invalid transaction file')
+            loader.get_event()
+        while not loader.check_event(yaml.MappingEndEvent):
+            key = loader.construct_document(loader.compose_node(None, None))
+            if key == 'transactions' and loader.check_event(
+                    yaml.SequenceStartEvent):
+                loader.get_event()
+                while not loader.check_event(yaml.SequenceEndEvent):
+                    yield loader.construct_document(
+                        loader.compose_node(None, None))
+                loader.get_event()
+            else:
+                loader.compose_node(None, None)
+    finally:
+        loader.dispose()
+
+
 @deletion_method
 @core_method
 def account_delete(account, lock_token=None):
@@ -1197,25 +2322,36 @@ def account_delete(account, lock_token=None):
     logger.warning('Deleting account {}'.format(account))
     token = account_lock(account, lock_token)
     try:
-        if not get_db().execute(sql("""
-        delete from transact where
-        account_debit_id=(select id from account where code=:code) or
-        account_credit_id=(select id from account where code=:code) and d=:d"""
-                                   ),
-                                code=account,
-                                d=datetime.datetime.fromtimestamp(0)).rowcount:
-            raise ResourceNotFound
-        if not get_db().execute(sql("""
-        delete from account where code=:code"""),
-                                code=account).rowcount:
-            logger.error('Account {} not found'.format(account))
-            raise ResourceNotFound
+        account_id = _account_id(account)
+        with _db_transaction(get_db()) as db:
+            cparties = [
+                r.account_credit_id for r in db.execute(sql("""
+            select distinct account_credit_id from transact where
+            account_debit_id=:account_id and account_credit_id is not null"""),
+                                                        account_id=account_id)
+            ]
+            if not db.execute(sql("""
+            delete from transact where
+            account_debit_id=:account_id or
+            account_credit_id=:account_id and d=:d"""),
+                              account_id=account_id,
+                              d=datetime.datetime.fromtimestamp(0)).rowcount:
+                raise ResourceNotFound
+            if not db.execute(sql("""
+            delete from account where id=:account_id"""),
+                              account_id=account_id).rowcount:
+                logger.error('Account {} not found'.format(account))
+                raise ResourceNotFound
+            # deleted transactions were credited from other accounts
+            for account_id in cparties:
+                _account_balance_rebuild(db, account_id)
+        _account_cache_invalidate(account)
     finally:
         account_unlock(account, token)
 
 
 @core_method
-def account_lock(account, token):
+def account_lock(account, token, timeout=None):
     """
     Lock account
 
@@ -1228,18 +2364,294 @@ def account_lock(account, token):
     When locked, all account transaction operation are freezed until unlocked
     (unless current lock token is provided for the operation)
 
+    Args:
+        account: account code
+        token: lock token
+        timeout: lock acquisition timeout (default: lock_timeout for local
+            locks, redis_blocking_timeout for Redis)
+
     Returns:
         specified lock token or new lock token if no token provided
     """
     account = account.upper()
     if config.keep_integrity:
-        with lock_account_token:
-            if account in account_lockers:
-                l = account_lockers[account]
+        if config.lock_mode == 'db':
+            return _db_lock_many([account])[account]
+        _writer_acquire(timeout)
+        try:
+            token = _account_locker(account).acquire(
+                token or _atomic_token(account), account, timeout=timeout)
+        except:
+            _writer_release()
+            raise
+        _atomic_hold(account, token)
+        return token
+
+
+def _account_locker(account):
+    with lock_account_token:
+        if account in account_lockers:
+            l = account_lockers[account]
+        else:
+            l = AccountLocker()
+            account_lockers[account] = l
+    return l
+
+
+def _account_try_lock(account):
+    """
+    Try to lock account without blocking
+
+    Returns:
+        lock token, None if integrity keeping is off or False if account is
+        already locked
+    """
+    if config.keep_integrity:
+        if config.lock_mode == 'db':
+            return False
+        if not _writer_acquire(blocking=False):
+            return False
+        token = _account_locker(account).acquire(account=account,
+                                                 blocking=False)
+        if token is False:
+            _writer_release()
+        return token
+
+
+def _writer_locking():
+    return config.sqlite_wal and config.lock_mode != 'db' and \
+            _db.engine is not None and _db.engine.name == 'sqlite'
+
+
+def _writer_acquire(timeout=None, blocking=True):
+    """
+    Acquire the process writer lock before an account lock (SQLite WAL mode)
+
+    DB transactions hold the writer lock while locking accounts (e.g. in
+    atomic blocks), so account locks are always acquired after it
+
+    Returns:
+        False if blocking is False and the lock is busy
+    """
+    if not _writer_locking():
+        return True
+    if not blocking:
+        return _d.sqlite_writer.acquire(blocking=False)
+    if timeout is None:
+        timeout = config.lock_timeout
+    if not _d.sqlite_writer.acquire(timeout=-1 if timeout is None else timeout):
+        raise RuntimeError('Unable to acquire account lock')
+    return True
+
+
+def _writer_release():
+    if _writer_locking():
+        _d.sqlite_writer.release()
+
+
+# sets all keys or none, returns 1 on success
+LUA_LOCK_MANY = """
+for i, key in ipairs(KEYS) do
+    if redis.call('exists', key) == 1 then
+        return 0
+    end
+end
+for i, key in ipairs(KEYS) do
+    redis.call('set', key, ARGV[1])
+end
+return 1
+"""
+
+REDIS_LOCK_SLEEP = 0.01
+
+
+@core_method
+def account_lock_many(accounts, tokens=None, timeout=None):
+    """
+    Lock multiple accounts
+
+    Accounts are locked in the canonical (sorted) order, so concurrent calls
+    can not deadlock each other. If Redis is used, all accounts are locked
+    with a single atomic operation
+
+    Args:
+        accounts: list of account codes
+        tokens: dict of tokens for already locked accounts
+        timeout: lock acquisition timeout
+
+    Returns:
+        dict account: token (None if integrity keeping is off)
+    """
+    given = {a.upper(): t for a, t in (tokens or {}).items() if a and t}
+    accounts = sorted({a.upper() for a in accounts if a})
+    if not config.keep_integrity:
+        return {a: None for a in accounts}
+    if config.lock_mode == 'db':
+        return _db_lock_many(accounts)
+    for a in accounts:
+        if a not in given and _atomic_token(a):
+            given[a] = _atomic_token(a)
+    result = {}
+    writer_holds = 0
+    try:
+        for a in accounts:
+            _writer_acquire(timeout)
+            writer_holds += 1
+        if _db.redis_conn:
+            # reentrant locks
+            for a in accounts:
+                if a in given:
+                    result[a] = _account_locker(a).acquire(given[a], a)
+            _redis_lock_many([a for a in accounts if a not in result],
+                             result, timeout)
+        else:
+            for a in accounts:
+                result[a] = _account_locker(a).acquire(given.get(a),
+                                                       a,
+                                                       timeout=timeout)
+    except:
+        account_unlock_many(result)
+        for _ in range(writer_holds - len([t for t in result.values() if t])):
+            _writer_release()
+        raise
+    for a, token in result.items():
+        _atomic_hold(a, token)
+    return result
+
+
+def _redis_lock_many(accounts, result, timeout):
+    if not accounts:
+        return
+    import uuid
+    token = uuid.uuid1().hex.encode()
+    if timeout is None:
+        timeout = config.redis_blocking_timeout
+    t_start = time.perf_counter()
+    script = _db.redis_conn.register_script(LUA_LOCK_MANY)
+    while not script(keys=accounts, args=[token]):
+        if timeout is not None and time.perf_counter() - t_start > timeout:
+            raise RuntimeError('Unable to acquire account lock')
+        time.sleep(REDIS_LOCK_SLEEP)
+    for a in accounts:
+        lock = _db.redis_conn.lock(a, thread_local=False)
+        lock.local.token = token
+        result[a] = _account_locker(a).set_redis_lock(lock)
+
+
+# PostgreSQL advisory lock key space
+PG_LOCK_NAMESPACE = 0x46494e41
+
+
+def _db_lock_many(accounts):
+    """
+    Lock accounts with database locks
+
+    All account locks of the thread share the same database transaction and
+    token, the transaction is committed (or rolled back, if failed) when the
+    last lock is released. If the transaction is already started outside,
+    it is not committed
+    """
+    db = get_db()
+    # ids are resolved before the transaction is started: on MySQL the first
+    # plain read would fix the transaction snapshot before the rows are locked
+    account_ids = [_account_id(a) for a in sorted(accounts)]
+    st = getattr(g, 'db_lock', None)
+    if st is None or not st.counter:
+        st = SimpleNamespace(token=gen_random_str(),
+                             counter=0,
+                             dbt=None,
+                             writer=None)
+        g.db_lock = st
+    try:
+        if not st.counter:
+            if _db.engine.name == 'sqlite':
+                # serialize writers of the process, BEGIN IMMEDIATE
+                # serializes processes
+                _d.sqlite_writer.acquire()
+                st.writer = _d.sqlite_writer
+            # join the outer transaction (e.g. of an atomic block) if started
+            if not db.in_transaction():
+                g.db_rollback = False
+                st.dbt = db.begin()
+        for account_id in account_ids:
+            if _db.engine.name == 'postgresql':
+                db.execute(sql('select pg_advisory_xact_lock(:ns, :id)'),
+                           ns=PG_LOCK_NAMESPACE,
+                           id=account_id)
+            elif _db.engine.name != 'sqlite':
+                db.execute(sql('select id from account where id=:id '
+                               'for update'),
+                           id=account_id)
+    except:
+        if not st.counter:
+            _db_lock_finish(st, rollback=True)
+        raise
+    st.counter += len(accounts)
+    return {a: st.token for a in accounts}
+
+
+def _db_unlock(token):
+    st = getattr(g, 'db_lock', None)
+    if st is None or token != st.token:
+        raise RuntimeError('Invalid token')
+    if st.counter < 1:
+        raise RuntimeError('Resource not locked')
+    st.counter -= 1
+    if not st.counter:
+        _db_lock_finish(st, rollback=getattr(g, 'db_rollback', False))
+
+
+def _db_lock_finish(st, rollback):
+    try:
+        if st.dbt:
+            if rollback:
+                st.dbt.rollback()
+                _cache_reset()
             else:
-                l = AccountLocker()
-                account_lockers[account] = l
-        return l.acquire(token, account)
+                st.dbt.commit()
+    finally:
+        st.dbt = None
+        g.db_rollback = False
+        if st.writer:
+            st.writer.release()
+            st.writer = None
+
+
+@core_method
+def account_unlock_many(tokens):
+    """
+    Unlock accounts, locked with account_lock_many
+
+    Args:
+        tokens: dict account: token
+    """
+    for a in sorted(tokens, reverse=True):
+        if tokens[a]:
+            account_unlock(a, tokens[a])
+
+
+@core_method
+def account_lock_stats():
+    """
+    Get account lock statistics
+
+    Returns:
+        list of dicts with fields:
+            account: account code
+            locked: is account currently locked
+            waiters: number of threads waiting for the lock
+            waits: total number of lock waits
+            wait_time: total time spent waiting for the lock (seconds)
+    """
+    with lock_account_token:
+        lockers = sorted(account_lockers.items())
+    return [{
+        'account': account,
+        'locked': l.counter > 0,
+        'waiters': l.waiters,
+        'waits': l.waits,
+        'wait_time': l.wait_time
+    } for account, l in lockers]
 
 
 @core_method
@@ -1251,11 +2663,14 @@ def account_unlock(account, token):
     otherwise it will be locked until process restart
     """
     if config.keep_integrity:
+        if config.lock_mode == 'db':
+            return _db_unlock(token)
         with lock_account_token:
             l = account_lockers.get(account.upper())
         if not l:
             raise ResourceNotFound
-        return l.release(token)
+        l.release(token)
+        _writer_release()
 
 
 def _ckw(kw, allowed):
@@ -1294,7 +2709,12 @@ def account_update(account, **kwargs):
     kw = kwargs.copy()
     if 'tp' in kw:
         kw['tp'] = ACCOUNT_TYPE_IDS[kw['tp']]
-    _update(account, 'account', 'code', kw)
+    try:
+        _update(account, 'account', 'code', kw)
+    finally:
+        _account_cache_invalidate(account)
+        if 'code' in kw:
+            _account_cache_invalidate(kw['code'])
 
 
 @core_method
@@ -1314,6 +2734,10 @@ def asset_update(asset, **kwargs):
         kw['precs'] = kw['precision']
         del kw['precision']
     _update(asset, 'asset', 'code', kw)
+    if 'code' in kw:
+        with lock_rate_index:
+            _rate_index.clear()
+        _account_cache_invalidate()
 
 
 @core_method
@@ -1339,7 +2763,16 @@ def transaction_update(transaction_id, **kwargs):
         kw['amount'] = parse_number(kw['amount'])
         if kw['amount'] <= 0:
             raise ValueError('Amount should be greater than zero')
-    _update(transaction_id, 'transact', 'id', kw)
+    with _db_transaction(get_db()) as db:
+        _update(transaction_id, 'transact', 'id', kw)
+        if 'd_created' in kw or 'd' in kw or 'amount' in kw:
+            t = db.execute(sql("""
+            select account_debit_id, account_credit_id from transact
+                where id=:id"""),
+                           id=transaction_id).fetchone()
+            for account_id in (t.account_debit_id, t.account_credit_id):
+                if account_id is not None:
+                    _account_balance_rebuild(db, account_id)
 
 
 @core_method
@@ -1373,8 +2806,8 @@ def transaction_create(account,
     elif amount is None and target is None:
         raise ValueError('Specify amount or target')
     token = account_lock(account, lock_token)
-    acc_info = account_info(account)
     try:
+        acc_info = account_info(account)
         if target is not None:
             target = parse_number(target)
             balance = account_balance(account)
@@ -1465,21 +2898,6 @@ def _transaction_move(dt=None,
         return
     if amount is not None and amount < 0:
         raise ValueError('Amount should be greater than zero')
-    if config.keep_integrity:
-        ccur = None
-        dcur = None
-        if ct:
-            acc_info = _ct_info
-            ctp = acc_info['tp']
-            m = acc_info['max_overdraft']
-            if m is not None and account_balance(ct) - amount < -1 * m:
-                raise OverdraftError
-        if dt:
-            acc_info = _dt_info
-            dtp = acc_info['tp']
-            m = acc_info['max_balance']
-            if m is not None and account_balance(dt) + amount > m:
-                raise OverlimitError
     if date is None:
         date = parse_date(return_timestamp=False)
     else:
@@ -1489,24 +2907,53 @@ def _transaction_move(dt=None,
             completion_date = date
     else:
         completion_date = parse_date(completion_date, return_timestamp=False)
-    r = db.execute(sql("""
-    insert into transact(account_credit_id, account_debit_id, amount, tag,
-    note, d_created, d, chain_transact_id) values
-    (
-    (select id from account where code=:ct),
-    (select id from account where code=:dt),
-    :amount, :tag, :note, :d_created, :d, :chain_id)
-    {}
-    """.format('' if _db.use_lastrowid else 'returning id')),
-                   ct=ct,
-                   dt=dt,
-                   amount=_multiply(amount),
-                   tag=tag,
-                   note=note,
-                   d_created=date,
-                   d=completion_date,
-                   chain_id=chain_transact_id)
-    return r.lastrowid if _db.use_lastrowid else r.fetchone().id
+    ct_id = _account_id(ct) if ct else None
+    dt_id = _account_id(dt) if dt else None
+    with _db_transaction(db):
+        if config.keep_integrity:
+            # limits are checked in the same DB transaction, balances are
+            # read only for accounts which have limits set
+            limits = {}
+            if ct and _ct_info['max_overdraft'] is not None:
+                limits[ct] = _account_info_cached(ct)
+            if dt and _dt_info['max_balance'] is not None:
+                limits[dt] = _account_info_cached(dt)
+            if limits:
+                balances = _account_balance_natural(db, limits)
+                if ct in limits and balances[ct] * (
+                        -1 if _ct_info['passive'] else 1
+                ) - amount < -1 * _ct_info['max_overdraft']:
+                    raise OverdraftError
+                if dt in limits and balances[dt] * (
+                        -1 if _dt_info['passive'] else
+                        1) + amount > _dt_info['max_balance']:
+                    raise OverlimitError
+        r = db.execute(sql("""
+        insert into transact(account_credit_id, account_debit_id, amount, tag,
+        note, d_created, d, chain_transact_id) values
+        (:ct, :dt, :amount, :tag, :note, :d_created, :d, :chain_id)
+        {}
+        """.format('' if _db.use_lastrowid else 'returning id')),
+                       ct=ct_id,
+                       dt=dt_id,
+                       amount=_multiply(amount),
+                       tag=tag,
+                       note=note,
+                       d_created=date,
+                       d=completion_date,
+                       chain_id=chain_transact_id)
+        tid = r.lastrowid if _db.use_lastrowid else r.fetchone().id
+        if ct:
+            _account_balance_apply(db,
+                                   -1 * _multiply(amount),
+                                   date,
+                                   account_id=ct_id)
+        if dt and completion_date is not None:
+            _account_balance_apply(db,
+                                   _multiply(amount),
+                                   completion_date,
+                                   account_id=dt_id)
+    return tid
 
 
 @core_method
@@ -1548,9 +2995,11 @@ def transaction_move(dt=None,
     """
     if ct and dt and ct == dt:
         raise ValueError('Credit and debit account can not be equal')
+    tokens = account_lock_many([ct, dt], {
+        ct: credit_lock_token,
+        dt: debit_lock_token
+    })
     try:
-        ctoken = account_lock(ct, credit_lock_token) if ct else None
-        dtoken = account_lock(dt, debit_lock_token) if dt else None
         ct_info = account_info(ct) if ct else None
         dt_info = account_info(dt) if dt else None
         if ct and dt and ct_info['asset'] != dt_info['asset']:
@@ -1574,7 +3023,6 @@ def transaction_move(dt=None,
                         amount = parse_number(target_dt) - current_balance
             if ct_info['passive'] and dt_info['passive']:
                 ct, dt = dt, ct
-                ctoken, dtoken = dtoken, ctoken
                 ct_info, dt_info = dt_info, ct_info
                 xdt = False if xdt else True
             if config.lazy_exchange:
@@ -1624,10 +3072,324 @@ def transaction_move(dt=None,
                                      _ct_info=ct_info,
                                      _dt_info=dt_info)
     finally:
-        if ctoken:
-            account_unlock(ct, ctoken)
-        if dtoken:
-            account_unlock(dt, dtoken)
+        account_unlock_many(tokens)
+
+
+lock_post = threading.Lock()
+
+
+def transaction_post(dt=None,
+                     ct=None,
+                     amount=0,
+                     tag=None,
+                     note=None,
+                     date=None,
+                     completion_date=None,
+                     mark_completed=True):
+    """
+    Submit standard transaction to the posting queue
+
+    The queue writer thread collects transactions, submitted within
+    post_delay, and creates them with transaction_move_many, in a single DB
+    transaction. If the batch fails (e.g. on overdraft), its transactions are
+    created one by one, so only failed ones get exceptions
+
+    Transactions are created outside of the caller's session/atomic block.
+    Targets and exchange operations are not supported
+
+    Args:
+        ct: source (credit) account code
+        dt: target (debit) account code
+        amount: transaction amount (always >0)
+        tag: transaction tag
+        note: transaction note
+        date: transaction creation date (default: now)
+        completion_date: transaction completion date (default: now)
+        mark_completed: mark transaction completed (set completion date)
+
+    Returns:
+        future (concurrent.futures.Future), resolved with transaction id
+    """
+    t = {
+        'dt': dt,
+        'ct': ct,
+        'amount': amount,
+        'tag': tag,
+        'note': note,
+        'date': parse_date(return_timestamp=False) if date is None else date,
+        'completion_date': completion_date,
+        'mark_completed': mark_completed
+    }
+    fut = Future()
+    with lock_post:
+        if _post.thread is None:
+            _post.queue = queue.Queue()
+            _post.thread = threading.Thread(target=_post_writer,
+                                            args=(_post.queue,),
+                                            name='finac_post_writer',
+                                            daemon=True)
+            _post.thread.start()
+        _post.queue.put((t, fut))
+    return fut
+
+
+def _post_writer(q):
+    stop = False
+    while not stop:
+        item = q.get()
+        if item is None:
+            break
+        items = [item]
+        deadline = time.perf_counter() + config.post_delay
+        while len(items) < config.post_batch_size:
+            try:
+                item = q.get(timeout=max(deadline - time.perf_counter(), 0))
+            except queue.Empty:
+                break
+            if item is None:
+                stop = True
+                break
+            items.append(item)
+        items = [(t, fut)
+                 for t, fut in items
+                 if fut.set_running_or_notify_cancel()]
+        if items:
+            # the writer must survive any failure, e.g. lost db connection
+            try:
+                with session():
+                    _post_commit(items)
+            except Exception as e:
+                logger.error('Posting batch failed: {}'.format(e))
+                for _, fut in items:
+                    if not fut.done():
+                        fut.set_exception(e)
+
+
+def _post_commit(items):
+    try:
+        ids = transaction_move_many([t for t, _ in items])
+    except Exception as e:
+        if len(items) == 1:
+            items[0][1].set_exception(e)
+            return
+        logger.debug('Posting batch failed, creating transactions one by one')
+        for t, fut in items:
+            try:
+                fut.set_result(transaction_move_many([t])[0])
+            except Exception as e:
+                fut.set_exception(e)
+        return
+    for (_, fut), tid in zip(items, ids):
+        fut.set_result(tid)
+
+
+@atexit.register
+def _post_stop():
+    """
+    Stop the posting queue writer, after all submitted transactions are
+    created
+    """
+    with lock_post:
+        if _post.thread is None:
+            return
+        _post.queue.put(None)
+        thread = _post.thread
+        _post.thread = None
+    thread.join()
+
+
+@core_method
+def transaction_move_many(transactions):
+    """
+    Create multiple standard transactions at once
+
+    All transactions are created in a single database transaction, accounts
+    are locked once, overdraft/overlimit are checked against running balances
+
+    Args:
+        transactions: list of dicts with transaction_move arguments (dt, ct,
+            amount, tag, note, date, completion_date, mark_completed). Targets
+            and exchange operations are not supported
+
+    Returns:
+        list of transaction ids (None for transactions with zero amount)
+    """
+    now = parse_date(return_timestamp=False)
+    moves = []
+    accounts = set()
+    for t in transactions:
+        unsupported = set(t) - {
+            'dt', 'ct', 'amount', 'tag', 'note', 'date', 'completion_date',
+            'mark_completed'
+        }
+        if unsupported:
+            raise ValueError('Unsupported arguments: {}'.format(', '.join(
+                sorted(unsupported))))
+        ct = t['ct'].upper() if t.get('ct') else None
+        dt = t['dt'].upper() if t.get('dt') else None
+        if ct == dt:
+            raise ValueError('Debit and credit account can not be the same')
+        amount = parse_number(t.get('amount'))
+        if amount is None:
+            raise ValueError('Specify amount')
+        elif amount < 0:
+            raise ValueError('Amount should be greater than zero')
+        date = parse_date(t['date'], return_timestamp=False) if t.get(
+            'date') is not None else now
+        if t.get('completion_date') is not None:
+            completion_date = parse_date(t['completion_date'],
+                                         return_timestamp=False)
+        elif t.get('mark_completed', True):
+            completion_date = date
+        else:
+            completion_date = None
+        moves.append(
+            SimpleNamespace(ct=ct,
+                            dt=dt,
+                            amount=amount,
+                            tag=t.get('tag'),
+                            note=t.get('note'),
+                            date=date,
+                            completion_date=completion_date))
+        accounts.update(a for a in (ct, dt) if a)
+    tokens = account_lock_many(accounts)
+    try:
+        info = {a: _account_info_cached(a) for a in accounts}
+        for m in moves:
+            if m.ct and m.dt:
+                if info[m.ct]['asset'] != info[m.dt]['asset']:
+                    raise ValueError('Asset mismatch')
+                if info[m.ct]['passive'] and info[m.dt]['passive']:
+                    m.ct, m.dt = m.dt, m.ct
+        rows = [
+            dict(ct=info[m.ct]['id'] if m.ct else None,
+                 dt=info[m.dt]['id'] if m.dt else None,
+                 amount=_multiply(m.amount),
+                 tag=m.tag,
+                 note=m.note,
+                 d_created=m.date,
+                 d=m.completion_date) for m in moves if m.amount
+        ]
+        deltas = {}
+
+        def _delta(account_id, amount, d):
+            x = deltas.setdefault(account_id, [0, d, d])
+            x[0] += amount
+            x[1] = min(x[1], d)
+            x[2] = max(x[2], d)
+
+        with _db_transaction(get_db()) as db:
+            if config.keep_integrity:
+                # limits are checked in the same DB transaction, balances are
+                # read only for accounts which have limits set
+                limits = {
+                    a: i
+                    for a, i in info.items()
+                    if i['max_overdraft'] is not None or
+                    i['max_balance'] is not None
+                }
+                balances = _account_balance_natural(db,
+                                                    limits) if limits else {}
+                # running balances are natural, limits are checked for
+                # displayed
+                for m in moves:
+                    if not m.amount:
+                        continue
+                    for account, amount, limit in (
+                        (m.ct, -1 * m.amount, 'max_overdraft'),
+                        (m.dt, m.amount if m.completion_date else 0,
+                         'max_balance')):
+                        if account not in balances:
+                            continue
+                        acc_info = info[account]
+                        balance = balances[account] * (
+                            -1 if acc_info['passive'] else 1)
+                        lim = acc_info[limit]
+                        if lim is not None:
+                            if limit == 'max_overdraft' and \
+                                    balance - m.amount < -1 * lim:
+                                raise OverdraftError
+                            elif limit == 'max_balance' and \
+                                    balance + m.amount > lim:
+                                raise OverlimitError
+                        balances[account] += amount
+            ids = []
+            if rows:
+                # the accounts are locked, so transactions inserted after the
+                # last known id for them are the created ones
+                last_id = db.execute(
+                    sql('select coalesce(max(id), 0) as id from transact')
+                ).fetchone().id
+                db.execute(
+                    sql("""
+                insert into transact(account_credit_id, account_debit_id,
+                    amount, tag, note, d_created, d) values
+                (:ct, :dt, :amount, :tag, :note, :d_created, :d)"""), rows)
+                account_ids = {i['id'] for i in info.values()}
+                ids = [
+                    r.id for r in db.execute(
+                        sql("""
+                    select id, account_credit_id, account_debit_id
+                        from transact where id > :last_id order by id"""),
+                        last_id=last_id)
+                    if r.account_credit_id in account_ids or
+                    r.account_debit_id in account_ids
+                ]
+                if len(ids) != len(rows):
+                    raise RuntimeError('Unable to get created transaction ids')
+            for row in rows:
+                if row['ct']:
+                    _delta(row['ct'], -1 * row['amount'], row['d_created'])
+                if row['dt'] and row['d'] is not None:
+                    _delta(row['dt'], row['amount'], row['d'])
+            for account_id, (amount, dmin, dmax) in deltas.items():
+                _account_balance_apply(db, amount, dmax, account_id)
+                _balance_checkpoint_invalidate(db, dmin, account_id)
+        ids = iter(ids)
+        result = [next(ids) if m.amount else None for m in moves]
+        return result
+    finally:
+        account_unlock_many(tokens)
+
+
+@core_method
+def transaction_create_many(transactions):
+    """
+    Create multiple simple transactions at once
+
+    Args:
+        transactions: list of dicts with transaction_create arguments
+            (account, amount, tag, note, date, completion_date,
+            mark_completed). Targets are not supported
+
+    Returns:
+        list of transaction ids
+    """
+    return transaction_move_many([_transaction_create_as_move(t) for t in
+                                  transactions])
+
+
+def _transaction_create_as_move(t):
+    """
+    Convert transaction_create arguments to transaction_move ones
+    """
+    t = t.copy()
+    if t.get('target') is not None:
+        raise ValueError('Targets are not supported')
+    t.pop('target', None)
+    account = t.pop('account')
+    amount = parse_number(t.get('amount'))
+    if amount is None:
+        raise ValueError('Specify amount')
+    if account_info(account)['passive']:
+        amount *= -1
+    if amount < 0:
+        t['ct'] = account
+        t['amount'] = -1 * amount
+    else:
+        t['dt'] = account
+        t['amount'] = amount
+    return t
 
 
 @core_method
@@ -1642,6 +3404,8 @@ def transaction_complete(transaction_ids,
     logger.info('Completing transaction {}'.format(transaction_ids))
     if completion_date is None:
         completion_date = parse_date(return_timestamp=False)
+    else:
+        completion_date = parse_date(completion_date, return_timestamp=False)
     if config.keep_integrity:
         ids = transaction_ids if isinstance(transaction_ids,
                                             (list,
@@ -1662,13 +3426,27 @@ def transaction_complete(transaction_ids,
                         'max_balance'] and account_balance(dt) + amount > \
                             acc_info['max_balance']:
                         raise OverlimitError
-                if not get_db().execute(sql("""
-                update transact set d=:d where id=:id"""),
-                                        d=completion_date,
-                                        id=transaction_id).rowcount:
-                    logger.error(
-                        'Transaction {} not found'.format(transaction_id))
-                    raise ResourceNotFound
+                with _db_transaction(get_db()) as db:
+                    t = db.execute(sql("""
+                    select account_debit_id, amount, d from transact
+                        where id=:id and deleted is null"""),
+                                   id=transaction_id).fetchone()
+                    if not db.execute(sql("""
+                    update transact set d=:d where id=:id"""),
+                                      d=completion_date,
+                                      id=transaction_id).rowcount:
+                        logger.error(
+                            'Transaction {} not found'.format(transaction_id))
+                        raise ResourceNotFound
+                    if t and t.account_debit_id is not None:
+                        if t.d is not None:
+                            _balance_checkpoint_invalidate(
+                                db, t.d, account_id=t.account_debit_id)
+                        _account_balance_apply(
+                            db,
+                            t.amount if t.d is None else 0,
+                            completion_date,
+                            account_id=t.account_debit_id)
             finally:
                 if config.keep_integrity and dt:
                     account_unlock(dt, token)
@@ -1685,14 +3463,31 @@ def transaction_delete(transaction_ids):
                                         (list, tuple)) else [transaction_ids]
     for transaction_id in ids:
         tinfo = transaction_info(transaction_id)
-        if not get_db().execute(sql("""
-        UPDATE transact SET
-            deleted=:ts WHERE (id=:id or chain_transact_id=:id) AND
-            service IS null"""),
-                                ts=parse_date(return_timestamp=False),
-                                id=transaction_id).rowcount:
-            logger.error('Transaction {} not found'.format(transaction_id))
-            raise ResourceNotFound
+        with _db_transaction(get_db()) as db:
+            rows = db.execute(sql("""
+            SELECT account_debit_id, account_credit_id, amount, d, d_created
+                FROM transact WHERE (id=:id or chain_transact_id=:id) AND
+                service IS null AND deleted IS null"""),
+                              id=transaction_id).fetchall()
+            if not db.execute(sql("""
+            UPDATE transact SET
+                deleted=:ts WHERE (id=:id or chain_transact_id=:id) AND
+                service IS null"""),
+                              ts=parse_date(return_timestamp=False),
+                              id=transaction_id).rowcount:
+                logger.error('Transaction {} not found'.format(transaction_id))
+                raise ResourceNotFound
+            for t in rows:
+                if t.account_debit_id is not None and t.d is not None:
+                    _account_balance_apply(db,
+                                           -1 * t.amount,
+                                           t.d,
+                                           account_id=t.account_debit_id)
+                if t.account_credit_id is not None:
+                    _account_balance_apply(db,
+                                           t.amount,
+                                           t.d_created,
+                                           account_id=t.account_credit_id)
         chid = tinfo.get('chain_transact_id')
         if chid:
             transaction_delete(chid)
@@ -1709,7 +3504,7 @@ def transaction_purge(_lock=True):
         lock_purge.acquire()
     try:
         db = get_db()
-        dbt = db.begin()
+        dbt = db.begin_nested() if db.in_transaction() else db.begin()
         logger.info('Purging deleted transactions')
         try:
             db.execute(
@@ -1848,17 +3643,17 @@ def account_statement(account,
     select transact.id, d_created, d,
             amount, tag, transact.note as note, account.code as cparty
         from transact left join account on
-            account_credit_id=account.id where account_debit_id=
-                (select id from account where code=:account) and {cond}
+            account_credit_id=account.id where account_debit_id=:account_id
+                and {cond}
     union
     select transact.id, d_created, d,
             amount * -1, tag, transact.note as note, account.code as cparty
         from transact left join account on
-            account_debit_id=account.id where account_credit_id=
-                (select id from account where code=:account) and {cond}
+            account_debit_id=account.id where account_credit_id=:account_id
+                and {cond}
         order by d_created, d
     """.format(cond=cond)),
-                         account=account.upper())
+                         account_id=_account_id(account))
     while True:
         d = r.fetchone()
         if not d:
@@ -1986,46 +3781,10 @@ def account_list(asset=None,
                                         _rsingle=True):
             yield acc
         return
-    cond = "transact.deleted is null"
-    if tp:
-        if isinstance(tp, str) and '|' in tp:
-            tp = tp.split('|')
-        tp = _safe_format(tp)
-        if not isinstance(tp, (list, tuple)):
-            if isinstance(tp, int):
-                tp_id = tp
-            else:
-                tp_id = ACCOUNT_TYPE_IDS[tp]
-            cond += (' and ' if cond else '') + 'account.tp = {}'.format(tp_id)
-        else:
-            cond += (' and (' if cond else '(')
-            cor = ''
-            for p in tp:
-                if isinstance(p, int):
-                    tp_id = p
-                else:
-                    tp_id = ACCOUNT_TYPE_IDS[p]
-                cor = cor + (' or '
-                             if cor else '') + 'account.tp = {}'.format(tp_id)
-            cond += cor + ')'
-    if asset:
-        first = True
-        cond += (' and ' if cond else '') + '('
-        for a in asset if isinstance(asset, list) or isinstance(
-                asset, tuple) else [asset]:
-            if first:
-                first = False
-            else:
-                cond += ' or '
-            cond += 'asset.code = \'{}\''.format(_safe_format(a.upper()))
-        cond += ')'
-    else:
-        cond += (' and ' if cond else '') + 'account.tp <= 1000'
+    cond = _account_filter_cond(tp=tp, asset=asset)
     dts = parse_date(date, return_timestamp=False,
                      ms=_time_ms) if date else parse_date(
                          return_timestamp=False)
-    cond += (' and '
-             if cond else '') + 'transact.d_created <= \'{}\''.format(dts)
     if code:
         cond += (' and ' if cond else '') + 'account.code like \'{}\''.format(
             _safe_format(code.upper()))
@@ -2041,8 +3800,13 @@ def account_list(asset=None,
             oby = ','.join(order_by)
         else:
             oby = order_by
-    r = get_db().execute(
-        sql("""
+    if date and config.balance_checkpoint:
+        r = _account_list_checkpoint(cond, _naive_date(dts), oby)
+    else:
+        cond = 'transact.deleted is null and {} and ' \
+                'transact.d_created <= \'{}\''.format(cond, dts)
+        r = get_db().execute(
+            sql("""
             select sum(balance) as balance, account, note, passive,
                 asset, tp from 
                 (
@@ -2075,8 +3839,8 @@ def account_list(asset=None,
                     group by account, note, passive, templist.asset, templist.tp
             {oby}
             """.format(cond=cond,
-                       cond_d=cond.replace('_created', ''),
-                       oby=('order by ' + oby) if oby else '')))
+                           cond_d=cond.replace('_created', ''),
+                           oby=('order by ' + oby) if oby else '')))
     while True:
         d = r.fetchone()
         if not d:
@@ -2095,10 +3859,105 @@ def account_list(asset=None,
                 row['balance'] *= -1
             row['balance'] = _demultiply(row['balance'])
             if base:
-                row['balance'] *= asset_rate(row['asset'], base, date=date)
+                row['balance'] *= _asset_rate_base(row['asset'],
+                                                   base,
+                                                   date=date)
             yield row
 
 
+def _account_list_checkpoint(cond, d, oby):
+    """
+    Get account balances for the past date, seeded from the nearest balance
+    checkpoints
+
+    Missing checkpoints of the date interval are created first
+    """
+    db = get_db()
+    if _balance_checkpoint_bucket(d) <= datetime.datetime.now():
+        for a in db.execute(
+                sql("""
+                select account.id as id, account.code as code from account
+                    join asset on asset.id=account.asset_id
+                    where {cond} and not exists
+                        (select 1 from balance_checkpoint
+                            where account_id=account.id
+                                and d >= :bucket and d <= :d)
+                """.format(cond=cond)),
+                bucket=_balance_checkpoint_bucket(d),
+                d=d).fetchall():
+            _balance_checkpoint_lookup(db, a.code, a.id, d)
+    return db.execute(
+        sql("""
+        select * from
+            (
+            select coalesce(cp.balance, 0) +
+                (select coalesce(sum(amount), 0) from transact
+                    where account_debit_id=account.id
+                        and deleted is null and d is not null and d <= :d
+                        and (cp.d is null or d > cp.d)) -
+                (select coalesce(sum(amount), 0) from transact
+                    where account_credit_id=account.id
+                        and deleted is null and d_created <= :d
+                        and (cp.d is null or d_created > cp.d)) as balance,
+                account.code as account,
+                account.note as note,
+                account.passive as passive,
+                asset.code as asset,
+                account.tp as tp
+                from account
+                join asset on asset.id=account.asset_id
+                left join balance_checkpoint as cp on cp.account_id=account.id
+                    and cp.d=(select max(d) from balance_checkpoint
+                        where account_id=account.id and d <= :d)
+                where {cond}
+            ) as templist
+        {oby}
+        """.format(cond=cond, oby=('order by ' + oby) if oby else '')),
+        d=d)
+
+
+def _account_filter_cond(tp=None, asset=None):
+    """
+    Format SQL condition to filter accounts by type and asset
+    """
+    cond = ''
+    if tp:
+        if isinstance(tp, str) and '|' in tp:
+            tp = tp.split('|')
+        tp = _safe_format(tp)
+        if not isinstance(tp, (list, tuple)):
+            if isinstance(tp, int):
+                tp_id = tp
+            else:
+                tp_id = ACCOUNT_TYPE_IDS[tp]
+            cond += (' and ' if cond else '') + 'account.tp = {}'.format(tp_id)
+        else:
+            cond += (' and (' if cond else '(')
+            cor = ''
+            for p in tp:
+                if isinstance(p, int):
+                    tp_id = p
+                else:
+                    tp_id = ACCOUNT_TYPE_IDS[p]
+                cor = cor + (' or '
+                             if cor else '') + 'account.tp = {}'.format(tp_id)
+            cond += cor + ')'
+    if asset:
+        first = True
+        cond += (' and ' if cond else '') + '('
+        for a in asset if isinstance(asset, list) or isinstance(
+                asset, tuple) else [asset]:
+            if first:
+                first = False
+            else:
+                cond += ' or '
+            cond += 'asset.code = \'{}\''.format(_safe_format(a.upper()))
+        cond += ')'
+    else:
+        cond += (' and ' if cond else '') + 'account.tp <= 1000'
+    return cond
+
+
 @core_method
 def account_list_summary(asset=None,
                          tp=None,
@@ -2144,7 +4003,7 @@ def account_list_summary(asset=None,
                      hide_empty=hide_empty,
                      _time_ms=_time_ms))
     for a in accounts:
-        a['balance_bc'] = a['balance'] * asset_rate(
+        a['balance_bc'] = a['balance'] * _asset_rate_base(
             a['asset'], base, date=date, _time_ms=_time_ms)
     if group_by:
         res = []
@@ -2172,7 +4031,7 @@ def account_list_summary(asset=None,
                     sum(
                         format_amount(d['balance'], d['asset'], d['passive'])
                         if d['asset'] == base else format_amount(
-                            d['balance'] * asset_rate(
+                            d['balance'] * _asset_rate_base(
                                 d['asset'], base, date=date, _time_ms=_time_ms),
                             d['asset'], d['passive']) for d in accounts)
             }
@@ -2196,7 +4055,8 @@ def account_list_summary(asset=None,
                     format_amount(d['balance'], d['asset'], d['passive']
                                  ) if d['asset'] == base else format_amount(
                                      d['balance'] *
-                                     asset_rate(d['asset'], base, date=date),
+                                     _asset_rate_base(
+                                         d['asset'], base, date=date),
                                      d['asset'], d['passive'])
                     for d in accounts)
         }
@@ -2356,28 +4216,43 @@ def archive_transactions(account=None,
         if not due_date:
             due_date = datetime.datetime.now()
         db = _db if _db else get_db()
-        if _open_dbt:
-            dbt = db.begin()
         if isinstance(tp, str) and '|' in tp:
             tp = tp.split('|')
         if not isinstance(tp, list):
             tp = [tp]
+        accounts = []
         for act in tp:
             if isinstance(tp, int):
                 tp_id = act
             else:
                 tp_id = ACCOUNT_TYPE_IDS[act]
-            for acc in db.execute(sql("""
+            accounts += [
+                acc.code for acc in db.execute(sql("""
                 SELECT code FROM account WHERE tp=:tp_id
                 """),
-                                  tp_id=tp_id).fetchall():
-                archive_transactions(account=acc.code,
+                                               tp_id=tp_id).fetchall()
+            ]
+        if _open_dbt:
+            dbt = db.begin_nested() if db.in_transaction() else db.begin()
+        tokens = {}
+        try:
+            tokens = account_lock_many(accounts)
+            for account in accounts:
+                archive_transactions(account=account,
                                      due_date=due_date,
                                      keep_deleted=keep_deleted,
+                                     lock_token=tokens[account.upper()],
                                      _open_dbt=False,
                                      _db=db)
-        if _open_dbt:
-            dbt.commit()
+            if _open_dbt:
+                dbt.commit()
+        except:
+            if _open_dbt:
+                dbt.rollback()
+                _cache_reset()
+            raise
+        finally:
+            account_unlock_many(tokens)
     else:
         account = account.upper()
         due_date = parse_date(due_date, return_timestamp=False)
@@ -2388,7 +4263,7 @@ def archive_transactions(account=None,
             logger.info('Archiving account transactions for {}'.format(account))
             if balance:
                 if _open_dbt:
-                    dbt = db.begin()
+                    dbt = db.begin() if not db.in_transaction() else None
                 d = datetime.datetime.now()
                 account_id = db.execute(sql("""
                         SELECT id FROM account WHERE code=:account
@@ -2437,12 +4312,204 @@ def archive_transactions(account=None,
                     ' AND deleted IS NULL' if keep_deleted else '')),
                            d=due_date,
                            account_id=account_id)
-                if _open_dbt:
+                _account_balance_rebuild(db, account_id)
+                if _open_dbt and dbt:
                     dbt.commit()
         finally:
             account_unlock(account, token)
 
 
+def _account_balance_apply(db, amount, d, account_id):
+    """
+    Apply transaction amount to the materialized account balance
+
+    Args:
+        db: DB connection
+        amount: raw (multiplied) signed amount
+        d: date the amount is effective since
+        account_id: account id
+    """
+    db.execute(sql("""
+        update account_balance_current set
+            balance=balance + :amount,
+            d=case when d is null or d < :d then :d else d end
+        where account_id=:account_id"""),
+               amount=amount,
+               d=d,
+               account_id=account_id)
+    _balance_checkpoint_invalidate(db, d, account_id=account_id)
+
+
+def _balance_checkpoint_invalidate(db, d=None, account_id=None):
+    """
+    Delete balance checkpoints of the account since the specified date (all
+    if no date specified)
+
+    Checkpoints are always invalidated, as they may be enabled later
+    """
+    db.execute(sql("""
+        delete from balance_checkpoint where account_id=:account_id {}
+        """.format('and d >= :d' if d else '')),
+               d=d,
+               account_id=account_id)
+
+
+def _balance_checkpoint_bucket(d):
+    """
+    Get start of the checkpoint interval for the naive date
+    """
+    if config.balance_checkpoint == 'monthly':
+        return d.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    else:
+        return d.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _balance_checkpoint_lookup(db, account, account_id, d):
+    """
+    Get raw account balance for the past date, using the nearest checkpoint
+
+    If the checkpoint for the date interval is missing, it is created
+    """
+
+    def _delta(start, end):
+        cond = ' and {0} <= :end'
+        if start is not None:
+            cond += ' and {0} > :start'
+        return db.execute(sql("""
+            select
+                (select coalesce(sum(amount), 0) from transact
+                    where account_debit_id=:account_id and d is not null
+                        and deleted is null {cond_d}) -
+                (select coalesce(sum(amount), 0) from transact
+                    where account_credit_id=:account_id
+                        and deleted is null {cond}) as balance
+            """.format(cond=cond.format('d_created'), cond_d=cond.format('d'))),
+                          account_id=account_id,
+                          start=start,
+                          end=end).fetchone().balance
+
+    d = _naive_date(d)
+    bucket = _balance_checkpoint_bucket(d)
+    cp = db.execute(sql("""
+        select d, balance from balance_checkpoint
+            where account_id=:account_id and d <= :d
+            order by d desc limit 1"""),
+                    account_id=account_id,
+                    d=d).fetchone()
+    if cp:
+        start = parse_date(cp.d, return_timestamp=False)
+        # stored timezone is the session one
+        if start.tzinfo:
+            start = start.replace(tzinfo=None)
+        balance = cp.balance
+    else:
+        start = None
+        balance = 0
+    if (start is None or start < bucket) and \
+            bucket <= datetime.datetime.now():
+        # don't store checkpoint if the account is being modified
+        token = _account_try_lock(account)
+        if token is not False:
+            try:
+                balance += _delta(start, bucket)
+                # the checkpoint may be already stored by a concurrent lookup
+                dbt = db.begin_nested() if db.in_transaction() else db.begin()
+                try:
+                    db.execute(sql("""
+                        insert into balance_checkpoint (account_id, d, balance)
+                        values (:account_id, :d, :balance)"""),
+                               account_id=account_id,
+                               d=bucket,
+                               balance=balance)
+                    dbt.commit()
+                except IntegrityError:
+                    dbt.rollback()
+                except:
+                    dbt.rollback()
+                    raise
+                start = bucket
+            finally:
+                if token:
+                    account_unlock(account, token)
+    return balance + _delta(start, d)
+
+
+def _account_balance_rebuild(db, account_id):
+    """
+    Recalculate materialized account balance from transactions
+    """
+    _balance_checkpoint_invalidate(db, account_id=account_id)
+    db.execute(sql("""
+        update account_balance_current set
+            balance=
+                (select coalesce(sum(amount), 0) from transact
+                    where account_debit_id=:account_id and d is not null
+                        and deleted is null) -
+                (select coalesce(sum(amount), 0) from transact
+                    where account_credit_id=:account_id
+                        and deleted is null),
+            d=(select max(md) from
+                (select max(d) as md from transact
+                    where account_debit_id=:account_id and d is not null
+                        and deleted is null
+                union all
+                select max(d_created) as md from transact
+                    where account_credit_id=:account_id
+                        and deleted is null) as m)
+        where account_id=:account_id"""),
+               account_id=account_id)
+
+
+def _account_balance_init():
+    """
+    Materialize balances for accounts which have no one yet
+    """
+    db = get_db()
+    with _db_transaction(db):
+        missing = [
+            r.id for r in db.execute(
+                sql("""
+            select id from account where id not in
+                (select account_id from account_balance_current)"""))
+        ]
+        for account_id in missing:
+            db.execute(sql("""
+                insert into account_balance_current (account_id, balance)
+                values (:account_id, 0)"""),
+                       account_id=account_id)
+            _account_balance_rebuild(db, account_id)
+
+
+def _account_balance_natural(db, accounts):
+    """
+    Get current natural balances of the accounts with a single query
+
+    Args:
+        db: DB connection
+        accounts: dict account code: account info (with id)
+
+    Returns:
+        dict account code: balance
+    """
+    codes = {i['id']: a for a, i in accounts.items()}
+    params = {'a{}'.format(n): i for n, i in enumerate(codes)}
+    result = {}
+    for r in db.execute(sql("""
+        select account_id, balance from account_balance_current
+            where account_id in ({}) and (d is null or d <= :d)
+            """.format(', '.join(':' + p for p in params))),
+                        d=parse_date(return_timestamp=False),
+                        **params):
+        account = codes[r.account_id]
+        result[account] = format_amount(_demultiply(r.balance),
+                                        accounts[account]['asset'])
+    for account in accounts:
+        if account not in result:
+            # materialized balance has future transactions
+            result[account] = account_balance(account, _natural=True)
+    return result
+
+
 @core_method
 def account_balance(account=None,
                     asset=None,
@@ -2476,19 +4543,31 @@ def account_balance(account=None,
     balance = None
     if account:
         acc_info = account_info(account)
-        r = get_db().execute(sql("""
-            select debit-credit as balance from
-                (select sum(amount) as debit from transact
-                    where account_debit_id=
-                        (select id from account where code=:account)
+        account_id = _account_id(account)
+        db = get_db()
+        # materialized balance is valid if there are no transactions after
+        # the requested date
+        d = db.execute(sql("""
+            select balance from account_balance_current
+                where account_id=:account_id and (d is null or d <= :d)
+                """),
+                       account_id=account_id,
+                       d=dts).fetchone()
+        if not d and config.balance_checkpoint:
+            d = SimpleNamespace(balance=_balance_checkpoint_lookup(
+                db, account.upper(), account_id, dts))
+        if not d:
+            d = db.execute(sql("""
+                select debit-credit as balance from
+                    (select sum(amount) as debit from transact
+                        where account_debit_id=:account_id
                             and d is not null and {cond_d}) as f,
-                (select sum(amount) as credit from transact
-                    where account_credit_id=
-                        (select id from account where code=:account) and {cond})
-                            as s
-                """.format(cond=cond, cond_d=cond.replace('_created', ''))),
-                             account=account.upper())
-        d = r.fetchone()
+                    (select sum(amount) as credit from transact
+                        where account_credit_id=:account_id
+                            and {cond}) as s
+                    """.format(cond=cond,
+                               cond_d=cond.replace('_created', ''))),
+                           account_id=account_id).fetchone()
         if not d or d.balance is None:
             raise ResourceNotFound
         balance = _demultiply(d.balance)
@@ -2582,28 +4661,116 @@ def account_balance_range(start,
         tp = [k for k in ACCOUNT_TYPE_IDS if ACCOUNT_TYPE_IDS[k] <= 1000]
     elif tp and '|' in tp:
         tp = [x.strip() for x in tp.split('|')]
-    acc_info = {'account': account} if account else {'tp': tp, 'asset': asset}
-    return _run_steps_func(start=start,
-                           end=end,
-                           step=step,
-                           return_timestamp=return_timestamp,
-                           fn=account_balance,
-                           kwargs={
-                               **acc_info, 'base': base
-                           },
-                           _time_ms=_time_ms)
+    times = _time_steps(start=start, end=end, step=step, _time_ms=_time_ms)
+    data = _account_balance_steps(times,
+                                  account=account,
+                                  tp=tp,
+                                  asset=asset,
+                                  base=base)
+    return [t.timestamp() for t in times] if return_timestamp else times, data
 
 
-def _run_steps_func(start,
-                    end,
-                    step,
-                    return_timestamp,
-                    fn,
-                    args=(),
-                    kwargs={},
-                    _time_ms=False):
-    times = []
+def _account_balance_steps(times, account=None, tp=None, asset=None, base=None):
+    """
+    Get account balances for the list of dates
+
+    Transaction amounts are fetched with a single query and summed up
+    cumulatively between the dates
+    """
+    if account:
+        acc_info = account_info(account)
+        cond = 'account.code = :account'
+    else:
+        cond = _account_filter_cond(tp=tp, asset=asset)
+    accounts = {}
+    steps = [_naive_date(t) for t in times]
+    if times:
+        r = get_db().execute(
+            sql("""
+            select account.code as account, account.passive as passive,
+                asset.code as asset, transact.d as d, transact.amount as amount
+                from transact
+                join account on account.id=transact.account_debit_id
+                join asset on asset.id=account.asset_id
+                where transact.d is not null and transact.deleted is null
+                    and transact.d <= :end and {cond}
+            union all
+            select account.code as account, account.passive as passive,
+                asset.code as asset, transact.d_created as d,
+                -1 * transact.amount as amount
+                from transact
+                join account on account.id=transact.account_credit_id
+                join asset on asset.id=account.asset_id
+                where transact.deleted is null
+                    and transact.d_created <= :end and {cond}
+            """.format(cond=cond)).columns(account=sa.String,
+                                          passive=sa.Boolean,
+                                          asset=sa.String,
+                                          d=sa.DateTime,
+                                          amount=sa.Float),
+            account=account.upper() if account else None,
+            end=steps[-1])
+        for row in r:
+            try:
+                a = accounts[row.account]
+            except KeyError:
+                a = SimpleNamespace(asset=row.asset,
+                                    passive=row.passive,
+                                    balance=0,
+                                    deltas=[0] * len(times))
+                accounts[row.account] = a
+            # stored timezone is the session one
+            d = row.d.replace(tzinfo=None) if row.d.tzinfo else row.d
+            a.deltas[bisect_left(steps, d)] += row.amount
     data = []
+    if account:
+        try:
+            a = accounts[account.upper()]
+        except KeyError:
+            raise ResourceNotFound
+        for i, t in enumerate(times):
+            a.balance += a.deltas[i]
+            balance = _demultiply(a.balance)
+            if base and acc_info['asset'] != base:
+                balance = balance * asset_rate(acc_info['asset'], base, date=t)
+            else:
+                balance = format_amount(balance, acc_info['asset'])
+            if acc_info['passive'] and balance:
+                balance *= -1
+            data.append(balance)
+    else:
+        if not base:
+            base = config.base_asset
+        rates = {}
+        rate_graphs = _rate_graphs(times) if accounts else []
+        for i, t in enumerate(times):
+            total = 0
+            for a in accounts.values():
+                a.balance += a.deltas[i]
+                # if zero is not a "real zero" - consider x < 0.000001 is zero
+                if abs(a.balance) > 0.000001:
+                    balance = _demultiply(a.balance)
+                    if a.passive:
+                        balance *= -1
+                    try:
+                        rate = rates[a.asset]
+                    except KeyError:
+                        rate = _asset_rate_base(a.asset,
+                                                base,
+                                                date=t,
+                                                rate_graph=rate_graphs[i])
+                        rates[a.asset] = rate
+                    total += format_amount(balance * rate, base, a.passive)
+            rates.clear()
+            data.append(total)
+    return data
+
+
+def _time_steps(start, end, step, _time_ms=False):
+    """
+    Split time range into the list of dates
+    """
+    times = []
     dt = parse_date(start, return_timestamp=False, ms=_time_ms)
     end_date = parse_date(end, return_timestamp=False,
                           ms=_time_ms) if end else datetime.datetime.now()
@@ -2622,13 +4789,25 @@ def _run_steps_func(start,
                 delta = datetime.timedelta(days=int(step))
         else:
             delta = datetime.timedelta(days=step)
-    while dt <= end_date or (autosteps and len(data) < step):
-        times.append(dt.timestamp() if return_timestamp else dt)
-        data.append(fn(*args, date=dt, **kwargs))
+    while dt <= end_date or (autosteps and len(times) < step):
+        times.append(dt)
         if delta is None:
             break
         dt += delta
-    return times, data
+    return times
+
+
+def _run_steps_func(start,
+                    end,
+                    step,
+                    return_timestamp,
+                    fn,
+                    args=(),
+                    kwargs={},
+                    _time_ms=False):
+    times = _time_steps(start=start, end=end, step=step, _time_ms=_time_ms)
+    data = [fn(*args, date=dt, **kwargs) for dt in times]
+    return [t.timestamp() for t in times] if return_timestamp else times, data
 
 
 def _safe_format(val):
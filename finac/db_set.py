@@ -90,6 +90,40 @@ def init_db(engine):
                      mysql_engine='InnoDB',
                      mysql_charset='utf8mb4')
 
+    account_balance_current = Table('account_balance_current',
+                                    meta,
+                                    Column('account_id',
+                                           Integer,
+                                           ForeignKey('account.id',
+                                                      ondelete='CASCADE'),
+                                           primary_key=True),
+                                    Column('balance',
+                                           Float(precision=32),
+                                           nullable=False,
+                                           server_default='0'),
+                                    Column('d',
+                                           DateTime(timezone=True),
+                                           nullable=True),
+                                    mysql_engine='InnoDB',
+                                    mysql_charset='utf8mb4')
+
+    balance_checkpoint = Table('balance_checkpoint',
+                               meta,
+                               Column('account_id',
+                                      Integer,
+                                      ForeignKey('account.id',
+                                                 ondelete='CASCADE'),
+                                      primary_key=True),
+                               Column('d',
+                                      DateTime(timezone=True),
+                                      nullable=False,
+                                      primary_key=True),
+                               Column('balance',
+                                      Float(precision=32),
+                                      nullable=False),
+                               mysql_engine='InnoDB',
+                               mysql_charset='utf8mb4')
+
     meta.create_all(engine)
     conn = engine.connect()
     for cur in ('EUR', 'USD'):
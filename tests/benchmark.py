@@ -13,6 +13,29 @@
  * to execute benchmark again on a large (1000k+ transactions db), it's
    recommended to drop transact and account tables manually (then restart finac
    server if you do a server benchmark)
+
+ * use -L to create accounts with overdraft/balance limits, so transaction
+   posting checks account balances
+
+ POSTING PATH (transaction_move, same asset, integrity keeper on, SQLite, local
+ in-process calls, best of 5x1000)
+
+                        statements   no limits   with limits
+   before                   10         1.384ms      1.720ms
+   single DB transaction     7         1.246ms      1.620ms
+   no connection pings       5         1.256ms      1.395ms
+
+   before: balances are read with two separate account_balance calls outside
+   of the posting DB transaction. After: balances are read with a single query
+   inside the posting transaction and only for accounts with limits set.
+   Statement counts are for accounts with limits, including "select 1"
+   connection pings
+
+ BALANCE RANGE (account_balance_range by account type, 366 daily steps,
+ 30 assets, 3650 rates: -a 2 -n 1 -R 30, SQLite)
+
+   rate graph per step        1.005s
+   single ordered rate scan   0.046s
 """
 
 from pathlib import Path
@@ -54,6 +77,19 @@ if __name__ == '__main__':
     ap.add_argument('--disable-keeper',
                     help='disable built-in integrity keeper',
                     action='store_true')
+    ap.add_argument('-L',
+                    '--limits',
+                    help='create accounts with overdraft/balance limits',
+                    action='store_true')
+    ap.add_argument('-R',
+                    '--rate-assets',
+                    help='benchmark balance range of N assets with rates',
+                    type=int,
+                    default=0)
+    ap.add_argument('--rates',
+                    help='total rates for the balance range benchmark',
+                    type=int,
+                    default=3650)
     ap.add_argument('-C',
                     '--clear',
                     help='clean database before start',
@@ -127,7 +163,13 @@ if __name__ == '__main__':
             print('Creating accounts...')
             # create accounts
             for x in tqdm(range(1, a.account_amount + 1), leave=True):
-                finac.account_create(f'account-{x}', 'USD')
+                if a.limits:
+                    finac.account_create(f'account-{x}',
+                                         'USD',
+                                         max_overdraft=1000000,
+                                         max_balance=1000000)
+                else:
+                    finac.account_create(f'account-{x}', 'USD')
         # generate transactions
         print('Generating transactions...')
         from benchmark_tools import generate_transactions
@@ -177,6 +219,25 @@ if __name__ == '__main__':
     wait_futures()
     print('Average statement time: {:.3f}ms'.format(
         (time.time() - t) / a.account_amount * 1000))
+    if a.rate_assets:
+        import datetime
+        print('Creating rates...')
+        start = datetime.datetime(2019, 1, 1)
+        for x in range(a.rate_assets):
+            finac.asset_create(f'RB{x}')
+            finac.account_create(f'rb-{x}', f'RB{x}', 'current')
+            finac.tr(f'rb-{x}', 100, date=start)
+        finac.asset_set_rates_bulk(
+            (f'RB{i % a.rate_assets}/USD', start + datetime.timedelta(
+                days=i // a.rate_assets * a.rate_assets * 366 // a.rates),
+             i + 1) for i in range(a.rates))
+        t = time.time()
+        finac.account_balance_range(start=start,
+                                    end=start + datetime.timedelta(days=365),
+                                    tp='current')
+        print('Balance range time ({} steps): {:.3f}s'.format(
+            366,
+            time.time() - t))
     if not a.benchmark_only and not a.finac_server:
         if a.dbconn == TEST_DB:
             os.unlink(TEST_DB)
@@ -18,6 +18,7 @@ import subprocess
 import requests
 import sqlalchemy
 import datetime
+import tempfile
 
 from sqlalchemy import text as sql
 
@@ -332,6 +333,16 @@ class Test(unittest.TestCase):
         finac.asset_set_rate('FKP/KPW', value=3)
         self.assertEqual(finac.asset_rate('NZD/KPW'), 15)
         self.assertEqual(round(finac.asset_rate('KPW/NZD') * 100, 2), 6.67)
+        rates = finac.asset_rate_vector(base='kpw')
+        self.assertEqual(rates['NZD'], 15)
+        self.assertEqual(rates['FKP'], 3)
+        self.assertEqual(rates['KPW'], 1)
+        finac.core.config_set('rate_cross_max_hops', 2)
+        try:
+            self.assertEqual(finac.asset_rate('NZD/FKP'), 5)
+            self.assertRaises(finac.RateNotFound, finac.asset_rate, 'NZD/KPW')
+        finally:
+            finac.core.config_set('rate_cross_max_hops', None)
 
     def test082_list_recent_rates(self):
         finac.lsa('*')
@@ -379,6 +390,14 @@ class Test(unittest.TestCase):
                                               return_timestamp=False)
         self.assertEqual(dt1[-4], 4140)
         self.assertEqual(dt1[-2], 5580)
+        t2, dt2 = finac.account_balance_range(start='2019-01-01',
+                                              tp='cash|current',
+                                              end='2019-8-07',
+                                              step='12a',
+                                              return_timestamp=True)
+        for d, balance in zip(t2, dt2):
+            self.assertEqual(
+                balance, finac.account_balance(tp='cash|current', date=d))
         res = list(
             finac.exec_query('SELECT account_balance_range('
                              'start="2019-01-05", '
@@ -719,6 +738,7 @@ class Test(unittest.TestCase):
     def test901_rate_list_cache(self):
         if config.remote:
             return
+        finac.core._cache.rate_list.clear()
         finac.asset_create('CA1')
         finac.asset_create('CA2')
         finac.asset_create('CA3')
@@ -862,6 +882,957 @@ class Test(unittest.TestCase):
         finac.account_delete('testa3')
         finac.account_delete('testap1')
 
+    def test904_balance_materialized(self):
+        if config.remote:
+            return
+
+        def _materialized(account):
+            return finac.core._demultiply(finac.core.get_db().execute(
+                sql("""select balance from account_balance_current
+                join account on account_id=account.id where code=:code"""),
+                code=account.upper()).fetchone().balance)
+
+        finac.account_create('testm1', 'USD')
+        finac.account_create('testm2', 'USD')
+        finac.tr('testm1', 1000)
+        t1 = finac.mv(dt='testm2', ct='testm1', amount=100, mark_completed=False)
+        t2 = finac.mv(dt='testm2', ct='testm1', amount=200)
+        self.assertEqual(finac.account_balance('testm1'), 700)
+        self.assertEqual(finac.account_balance('testm2'), 200)
+        finac.complete(t1)
+        self.assertEqual(finac.account_balance('testm2'), 300)
+        finac.rm(t2)
+        finac.transaction_update(t1, amount=50)
+        self.assertEqual(finac.account_balance('testm1'), 950)
+        self.assertEqual(finac.account_balance('testm2'), 50)
+        d = datetime.datetime.now() + datetime.timedelta(days=1)
+        finac.mv(dt='testm2', ct='testm1', amount=10, date=d)
+        self.assertEqual(finac.account_balance('testm1'), 950)
+        self.assertEqual(
+            finac.account_balance('testm1',
+                                  date=d + datetime.timedelta(seconds=1)), 940)
+        self.assertEqual(_materialized('testm1'), 940)
+        self.assertEqual(_materialized('testm2'), 60)
+        finac.account_delete('testm1')
+        finac.account_delete('testm2')
+
+    def test905_balance_checkpoint(self):
+        # checkpoints are not created in db lock mode
+        if config.remote or finac.config.lock_mode == 'db':
+            return
+
+        def _checkpoints():
+            return finac.core.get_db().execute(
+                sql("""select count(*) as c from balance_checkpoint
+                join account on account_id=account.id where code='TESTC1'""")
+            ).fetchone().c
+
+        finac.core.config_set('balance_checkpoint', 'daily')
+        try:
+            finac.account_create('testc1', 'USD')
+            finac.tr('testc1', 100, date='2019-01-01 10:00')
+            finac.tr('testc1', 50, date='2019-01-02 10:00')
+            finac.tr('testc1', 25, date='2019-01-03 10:00')
+            self.assertEqual(
+                finac.account_balance('testc1', date='2019-01-02 12:00'), 150)
+            self.assertEqual(_checkpoints(), 1)
+            self.assertEqual(
+                finac.account_balance('testc1', date='2019-01-02 09:00'), 100)
+            self.assertEqual(
+                finac.account_balance('testc1', date='2019-01-03 09:00'), 150)
+            self.assertEqual(_checkpoints(), 2)
+            finac.tr('testc1', 10, date='2019-01-02 11:00')
+            self.assertEqual(_checkpoints(), 1)
+            self.assertEqual(
+                finac.account_balance('testc1', date='2019-01-03 09:00'), 160)
+            self.assertEqual(
+                finac.account_balance('testc1', date='2019-01-03 11:00'), 185)
+            self.assertEqual(
+                finac.account_balance('testc1', date='2019-01-02 12:00'), 160)
+            finac.account_delete('testc1')
+        finally:
+            finac.core.config_set('balance_checkpoint', None)
+
+    def test906_rate_index(self):
+        if config.remote:
+            return
+        finac.core.config_set('rate_index', True)
+        try:
+            finac.asset_create('RI1')
+            finac.asset_set_rate('RI1/USD', 2, date='2019-01-01')
+            finac.asset_set_rate('RI1/USD', 3, date='2019-01-03')
+            self.assertEqual(finac.asset_rate('RI1/USD', date='2019-01-02'), 2)
+            self.assertEqual(finac.asset_rate('USD/RI1', date='2019-01-04'),
+                             1 / 3)
+            self.assertRaises(finac.RateNotFound,
+                              finac.asset_rate,
+                              'RI1/USD',
+                              date='2018-12-31')
+            finac.asset_set_rate('RI1/USD', 4, date='2019-01-02')
+            self.assertEqual(
+                finac.asset_rate_range(start='2019-01-01',
+                                       end='2019-01-04',
+                                       asset='RI1/USD')[1], [2, 4, 3, 3])
+            finac.asset_delete_rate('RI1/USD', date='2019-01-02')
+            self.assertEqual(finac.asset_rate('RI1/USD', date='2019-01-02'), 2)
+            finac.asset_set_rate('RI1/USD', 5, date='2019-01-05T00:00:00+00:00')
+            self.assertEqual(
+                finac.asset_rate('RI1/USD', date='2019-01-06T00:00:00+00:00'),
+                5)
+            finac.asset_delete('RI1')
+        finally:
+            finac.core.config_set('rate_index', False)
+
+    def test907_account_cache(self):
+        finac.asset_create('AC1')
+        finac.account_create('ACC1', 'AC1', max_overdraft=10)
+        self.assertEqual(finac.account_info('acc1')['max_overdraft'], 10)
+        finac.account_update('acc1', max_overdraft=20)
+        self.assertEqual(finac.account_info('acc1')['max_overdraft'], 20)
+        self.assertRaises(finac.OverdraftError,
+                          finac.transaction_move,
+                          ct='acc1',
+                          amount=30)
+        finac.account_update('acc1', code='acc2')
+        self.assertRaises(finac.ResourceNotFound, finac.account_info, 'acc1')
+        self.assertRaises(finac.ResourceNotFound,
+                          finac.transaction_move,
+                          dt='acc1',
+                          amount=5)
+        finac.transaction_move(dt='acc2', amount=5)
+        self.assertEqual(finac.account_balance('acc2'), 5)
+        finac.asset_update('ac1', code='AC2')
+        self.assertEqual(finac.account_info('acc2')['asset'], 'AC2')
+        self.assertRaises(finac.ResourceNotFound, finac.asset_set_rate,
+                          'AC1/USD', 2)
+        finac.asset_set_rate('AC2/USD', 2)
+        self.assertEqual(finac.account_balance('acc2', base='usd'), 10)
+        finac.account_delete('acc2')
+        self.assertRaises(finac.ResourceNotFound, finac.account_info, 'acc2')
+        finac.asset_delete('ac2')
+
+    def test908_move_many(self):
+        finac.asset_create('MM1')
+        finac.account_create('MM.A', 'MM1', max_overdraft=100)
+        finac.account_create('MM.B', 'MM1', max_balance=200)
+        finac.account_create('MM.L', 'MM1', tp='supplier')
+        ids = finac.transaction_create_many([
+            dict(account='mm.a', amount=50, tag='init'),
+            dict(account='mm.l', amount=30)
+        ])
+        self.assertEqual(len(ids), 2)
+        self.assertEqual(finac.account_balance('mm.l'), 30)
+        ids = finac.transaction_move_many([
+            dict(ct='mm.a', dt='mm.b', amount=100, note='x'),
+            dict(ct='mm.a', dt='mm.b', amount=0),
+            dict(ct='mm.a', dt='mm.b', amount=25, mark_completed=False)
+        ])
+        self.assertEqual(len(ids), 3)
+        self.assertIsNone(ids[1])
+        self.assertEqual(finac.core.transaction_info(ids[0])['note'], 'x')
+        self.assertEqual(finac.core.transaction_info(ids[2])['amount'], 25)
+        self.assertEqual(finac.account_balance('mm.a'), -75)
+        self.assertEqual(finac.account_balance('mm.b'), 100)
+        self.assertEqual(
+            [r['note'] for r in finac.account_statement('mm.b')].count('x'), 1)
+        # the second move exceeds overdraft after the first one
+        self.assertRaises(finac.OverdraftError, finac.transaction_move_many, [
+            dict(ct='mm.a', dt='mm.b', amount=20),
+            dict(ct='mm.a', dt='mm.b', amount=10)
+        ])
+        self.assertRaises(finac.OverlimitError, finac.transaction_move_many,
+                          [dict(ct='mm.a', dt='mm.b', amount=5)] * 2 +
+                          [dict(dt='mm.b', amount=91)])
+        self.assertEqual(finac.account_balance('mm.a'), -75)
+        self.assertEqual(finac.account_balance('mm.b'), 100)
+        finac.transaction_complete(ids[2])
+        self.assertEqual(finac.account_balance('mm.b'), 125)
+        finac.asset_delete('MM1')
+        finac.cleanup()
+
+    def test909_import(self):
+        finac.asset_create('IM1')
+        finac.account_create('IM.A', 'IM1')
+        finac.account_create('IM.B', 'IM1', max_balance=100)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fcsv = tmpdir + '/tr.csv'
+            with open(fcsv, 'w') as fh:
+                fh.write(
+                    dedent("""
+                    account,dt,ct,amount,tag,mark_completed
+                    im.a,,,10,csv,
+                    ,im.b,im.a,5,csv,1
+                    im.x,,,1,,
+                    ,im.b,im.a,1000,,
+                    ,im.b,im.a,2,,0
+                    """).lstrip())
+            progress = []
+            result = finac.transaction_import(fcsv,
+                                              chunk_size=2,
+                                              on_progress=progress.append)
+            self.assertEqual(progress, [2, 4, 5])
+            self.assertEqual(result['processed'], 5)
+            self.assertEqual(result['created'], 3)
+            self.assertEqual([e[0] for e in result['errors']], [3, 4])
+            self.assertEqual(result['errors'][0][2],
+                             'ResourceNotFound: account IM.X')
+            self.assertEqual(finac.account_balance('im.a'), 3)
+            self.assertEqual(finac.account_balance('im.b'), 5)
+            fjsonl = tmpdir + '/tr.jsonl'
+            with open(fjsonl, 'w') as fh:
+                for i in range(5):
+                    fh.write('{"account": "im.a", "amount": %u}\n' % (i + 1))
+            state_file = tmpdir + '/state'
+            with open(state_file, 'w') as fh:
+                fh.write('3')
+            result = finac.transaction_import(fjsonl, state_file=state_file)
+            self.assertEqual(result['processed'], 5)
+            self.assertEqual(result['created'], 2)
+            self.assertFalse(os.path.exists(state_file))
+            self.assertEqual(finac.account_balance('im.a'), 12)
+            fyaml = tmpdir + '/tr.yml'
+            with open(fyaml, 'w') as fh:
+                fh.write(
+                    dedent("""
+                    note: test
+                    transactions:
+                      - account: im.a
+                        amount: -2
+                      - dt: im.b
+                        ct: im.a
+                        amount: 3
+                    """))
+            result = finac.transaction_import(fyaml)
+            self.assertEqual(result['created'], 2)
+            self.assertEqual(finac.account_balance('im.a'), 7)
+            self.assertEqual(finac.account_balance('im.b'), 8)
+        finac.asset_delete('IM1')
+        finac.cleanup()
+
+    def test910_rates_bulk(self):
+        finac.asset_create('RB1')
+        finac.asset_set_rate('RB1/USD', 1, date='2019-01-02')
+        self.assertEqual(finac.asset_rate('RB1/USD', date='2019-01-02'), 1)
+        self.assertEqual(
+            finac.asset_set_rates_bulk([('RB1/USD', '2019-01-01', 2),
+                                        ('rb1/usd', '2019-01-02', 3),
+                                        ('RB1/EUR', '2019-01-02', 4)]), 3)
+        self.assertEqual(finac.asset_rate('RB1/USD', date='2019-01-01'), 2)
+        self.assertEqual(finac.asset_rate('RB1/USD', date='2019-01-02'), 3)
+        self.assertRaises(finac.ResourceNotFound, finac.asset_set_rates_bulk,
+                          [('RB1/USD', '2019-01-03', 5),
+                           ('RB1/XXX', '2019-01-03', 5)])
+        self.assertEqual(finac.asset_rate('RB1/USD', date='2019-01-03'), 3)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open(tmpdir + '/rates.csv', 'w') as fh:
+                fh.write('asset_from,asset_to,date,value\n'
+                         'RB1,USD,2019-01-03,5\n'
+                         'RB1,USD,2019-01-04,6\n')
+            with open(tmpdir + '/rates.jsonl', 'w') as fh:
+                fh.write('["RB1/USD", "2019-01-04", 7]\n'
+                         '{"pair": "RB1/USD", "date": "2019-01-05",'
+                         ' "value": 8}\n')
+            self.assertEqual(
+                finac.asset_import_rates(tmpdir + '/rates.csv', chunk_size=1),
+                2)
+            self.assertEqual(finac.asset_import_rates(tmpdir + '/rates.jsonl'),
+                             2)
+        self.assertEqual(
+            finac.asset_rate_range(start='2019-01-01',
+                                   end='2019-01-05',
+                                   asset='RB1/USD')[1], [2, 3, 5, 7, 8])
+        finac.asset_delete('RB1')
+
+    def test911_jrpc_batch(self):
+        if not config.remote:
+            return
+        finac.asset_create('JB1')
+
+        def _req(i, method, **params):
+            params['_k'] = 'secret'
+            return {'jsonrpc': '2.0', 'id': i, 'method': method,
+                    'params': params}
+
+        batch = [_req(0, 'account_create', account='JB.A', asset='JB1')]
+        for i in range(1, 21):
+            batch.append(
+                _req(i, 'transaction_create', account='jb.a', amount=i))
+            batch.append(_req(i + 100, 'account_balance', account='jb.a'))
+        batch.append(_req(999, 'account_balance', account='jb.x'))
+        result = requests.post(finac.config.api_uri, json=batch).json()
+        self.assertEqual([r['id'] for r in result], [r['id'] for r in batch])
+        balances = [r['result'] for r in result if 100 < r['id'] < 999]
+        self.assertEqual(balances, [i * (i + 1) / 2 for i in range(1, 21)])
+        self.assertEqual(result[-1]['error']['code'], -32001)
+        finac.asset_delete('JB1')
+        finac.cleanup()
+
+    def test912_ndjson_stream(self):
+        if not config.remote:
+            return
+        import json
+        finac.asset_create('ND1')
+        finac.account_create('ND.A', 'ND1')
+        for i in range(5):
+            finac.transaction_create('nd.a', i + 1, note=str(i))
+        req = {
+            'jsonrpc': '2.0',
+            'id': 1,
+            'method': 'account_statement',
+            'params': {
+                'account': 'nd.a',
+                '_k': 'secret'
+            }
+        }
+        r = requests.post(finac.config.api_uri,
+                          json=req,
+                          headers={'Accept': 'application/x-ndjson'})
+        self.assertEqual(r.headers['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in r.text.splitlines()]
+        self.assertEqual([row['note'] for row in rows],
+                         [str(i) for i in range(5)])
+        self.assertEqual(
+            rows,
+            requests.post(finac.config.api_uri, json=req).json()['result'])
+        req['params']['account'] = 'nd.x'
+        r = requests.post(finac.config.api_uri,
+                          json=req,
+                          headers={'Accept': 'application/x-ndjson'})
+        self.assertEqual(r.json()['error']['code'], -32001)
+        uri = finac.config.api_uri.rsplit('/', 1)[0] + '/query'
+        r = requests.get(uri,
+                         params={
+                             'q': 'select account_statement(account="nd.a")',
+                             'stream': '1'
+                         },
+                         headers={'X-Auth-Key': 'secret'})
+        self.assertEqual(len(r.text.splitlines()), 5)
+        finac.asset_delete('ND1')
+        finac.cleanup()
+
+    def test913_api_session(self):
+        if not config.remote:
+            return
+        finac.asset_list()
+        session = finac.core._api.session
+        self.assertIsNotNone(session)
+        errors = []
+
+        def _worker():
+            try:
+                for _ in range(5):
+                    finac.asset_precision('usd')
+            except Exception as e:
+                errors.append(e)
+
+        workers = [threading.Thread(target=_worker) for _ in range(5)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        self.assertEqual(errors, [])
+        self.assertIs(finac.core._api.session, session)
+
+    def test914_batch(self):
+        finac.asset_create('BT1')
+        finac.account_create('BT.A', 'BT1')
+        finac.transaction_create('bt.a', 10)
+        with finac.batch() as b:
+            f1 = finac.account_balance('bt.a')
+            f2 = finac.account_info('bt.a')
+            f3 = finac.account_balance('bt.x')
+            f4 = finac.transaction_create('bt.a', 5)
+            if config.remote:
+                self.assertFalse(f1.done())
+        self.assertEqual(b, [f1, f2, f3, f4])
+        self.assertEqual(f1.result(), 10)
+        self.assertEqual(f2.result()['asset'], 'BT1')
+        self.assertRaises(finac.ResourceNotFound, f3.result)
+        self.assertIsInstance(f4.result(), int)
+        self.assertEqual(finac.account_balance('bt.a'), 15)
+        with self.assertRaises(RuntimeError):
+            with finac.batch():
+                with finac.batch():
+                    pass
+        finac.asset_delete('BT1')
+        finac.cleanup()
+
+    def test915_msgpack(self):
+        if not config.remote or finac.core.msgpack is None:
+            return
+        finac.asset_create('MP1')
+        finac.account_create('MP.A', 'MP1')
+        finac.transaction_create('mp.a',
+                                 10,
+                                 date=datetime.datetime(2019, 3, 4, 12))
+        self.assertTrue(finac.core._api.msgpack)
+        times, values = finac.account_balance_range(
+            account='mp.a', start=datetime.datetime(2019, 3, 3),
+            end='2019-03-05')
+        self.assertEqual(times, [
+            datetime.datetime(2019, 3, 3),
+            datetime.datetime(2019, 3, 4),
+            datetime.datetime(2019, 3, 5)
+        ])
+        self.assertEqual(values, [0, 0, 10])
+        finac.asset_delete('MP1')
+        finac.cleanup()
+
+    def test916_lock_fifo(self):
+        if config.remote or finac.core._db.redis_conn or \
+                finac.config.lock_mode == 'db' or finac.config.sqlite_wal:
+            return
+        finac.asset_create('LF1')
+        finac.account_create('LF.A', 'LF1')
+        token = finac.core.account_lock('lf.a', None)
+        order = []
+
+        def _worker(n):
+            t = finac.core.account_lock('lf.a', None)
+            order.append(n)
+            finac.core.account_unlock('lf.a', t)
+
+        workers = []
+        for n in range(5):
+            w = threading.Thread(target=_worker, args=(n,))
+            w.start()
+            workers.append(w)
+            while [
+                    s['waiters']
+                    for s in finac.core.account_lock_stats()
+                    if s['account'] == 'LF.A'
+            ][0] < n + 1:
+                time.sleep(0.001)
+        self.assertRaises(RuntimeError,
+                          finac.core.account_lock,
+                          'lf.a',
+                          None,
+                          timeout=0.01)
+        finac.core.account_unlock('lf.a', token)
+        for w in workers:
+            w.join()
+        self.assertEqual(order, list(range(5)))
+        stats = [
+            s for s in finac.core.account_lock_stats()
+            if s['account'] == 'LF.A'
+        ][0]
+        self.assertFalse(stats['locked'])
+        self.assertEqual(stats['waiters'], 0)
+        self.assertEqual(stats['waits'], 6)
+        self.assertGreater(stats['wait_time'], 0)
+        finac.asset_delete('LF1')
+        finac.cleanup()
+
+    def test917_lock_many(self):
+        if config.remote:
+            return
+        finac.asset_create('LM1')
+        finac.account_create('LM.A', 'LM1')
+        finac.account_create('LM.B', 'LM1')
+        finac.transaction_create('lm.a', 100)
+        finac.transaction_create('lm.b', 100)
+        errors = []
+
+        def _worker(ct, dt):
+            try:
+                for _ in range(20):
+                    finac.transaction_move(ct=ct, dt=dt, amount=1)
+            except Exception as e:
+                errors.append(e)
+
+        finac.core.config_set('lock_timeout', 5)
+        try:
+            workers = [
+                threading.Thread(target=_worker, args=args)
+                for args in [('lm.a', 'lm.b'), ('lm.b', 'lm.a')] * 3
+            ]
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+        finally:
+            finac.core.config_set('lock_timeout', None)
+        self.assertEqual(errors, [])
+        self.assertEqual(finac.account_balance('lm.a'), 100)
+        self.assertEqual(finac.account_balance('lm.b'), 100)
+        tokens = finac.core.account_lock_many(['lm.b', 'lm.a'])
+        self.assertEqual(list(tokens), ['LM.A', 'LM.B'])
+        # reentrant
+        self.assertEqual(
+            finac.core.account_lock_many(['lm.a'], tokens=tokens)['LM.A'],
+            tokens['LM.A'])
+        finac.core.account_unlock('lm.a', tokens['LM.A'])
+        finac.core.account_unlock_many(tokens)
+        self.assertEqual(len(list(finac.account_statement('lm.a'))), 121)
+        finac.archive_transactions(account='lm.a')
+        # archived transactions are replaced with a service one
+        self.assertEqual(finac.account_balance('lm.a'), 100)
+        self.assertEqual(len(list(finac.account_statement('lm.a'))), 0)
+        self.assertEqual(len(list(finac.account_statement('lm.b'))), 121)
+        finac.asset_delete('LM1')
+        finac.cleanup()
+
+    def test918_move_limits(self):
+        finac.asset_create('ML1')
+        finac.account_create('ML.A', 'ML1', max_overdraft=100)
+        finac.account_create('ML.B', 'ML1', max_balance=150)
+        finac.account_create('ML.C', 'ML1')
+        finac.transaction_move(ct='ml.a', dt='ml.b', amount=60)
+        # future transaction, materialized balance can not be used
+        finac.transaction_move(ct='ml.a',
+                               dt='ml.c',
+                               amount=30,
+                               date=datetime.datetime.now() +
+                               datetime.timedelta(days=1))
+        self.assertRaises(finac.OverdraftError,
+                          finac.transaction_move,
+                          ct='ml.a',
+                          dt='ml.c',
+                          amount=41)
+        self.assertRaises(finac.OverlimitError,
+                          finac.transaction_move,
+                          ct='ml.c',
+                          dt='ml.b',
+                          amount=91)
+        finac.transaction_move(ct='ml.a', dt='ml.b', amount=40)
+        self.assertEqual(finac.account_balance('ml.a'), -100)
+        self.assertEqual(finac.account_balance('ml.b'), 100)
+        self.assertEqual(len(list(finac.account_statement('ml.b'))), 2)
+        finac.asset_delete('ML1')
+        finac.cleanup()
+
+    def test919_db_reconnect(self):
+        if config.remote:
+            return
+        db = finac.core.get_db()
+        self.assertIs(finac.core.get_db(), db)
+        db.invalidate()
+        db2 = finac.core.get_db()
+        self.assertIsNot(db2, db)
+        self.assertEqual(db2.execute('select 1').fetchone()[0], 1)
+        self.assertIs(finac.core.get_db(), db2)
+
+    def test920_session(self):
+        if config.remote:
+            return
+        finac.asset_create('SS1')
+        finac.account_create('SS.A', 'SS1')
+        finac.account_create('SS.B', 'SS1')
+        with finac.session() as db:
+            self.assertIs(finac.core.get_db(), db)
+            with finac.session():
+                finac.transaction_move(ct='ss.a', dt='ss.b', amount=10)
+            self.assertIs(finac.core.g.db, db)
+        self.assertIsNone(finac.core.g.db)
+        try:
+            with finac.session(transaction=True):
+                finac.transaction_move(ct='ss.a', dt='ss.b', amount=5)
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        self.assertEqual(finac.account_balance('ss.b'), 10)
+        with finac.session(transaction=True):
+            finac.transaction_move(ct='ss.a', dt='ss.b', amount=5)
+            finac.transaction_move(ct='ss.a', dt='ss.b', amount=5)
+        self.assertEqual(finac.account_balance('ss.b'), 20)
+        self.assertEqual(
+            finac.core.spawn(finac.account_balance, 'ss.b').result(), 20)
+        finac.asset_delete('SS1')
+        finac.cleanup()
+
+    def test921_atomic(self):
+        if config.remote:
+            return
+
+        def _locked(account):
+            return [
+                s['locked']
+                for s in finac.core.account_lock_stats()
+                if s['account'] == account
+            ] == [True]
+
+        finac.asset_create('AT1')
+        finac.account_create('AT.A', 'AT1')
+        finac.account_create('AT.B', 'AT1')
+        with finac.atomic():
+            finac.transaction_move(ct='at.a', dt='at.b', amount=10)
+            with finac.atomic():
+                finac.transaction_move(ct='at.a', dt='at.b', amount=5)
+            try:
+                with finac.atomic():
+                    finac.transaction_move(ct='at.a', dt='at.b', amount=7)
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+            if finac.config.lock_mode != 'db':
+                self.assertTrue(_locked('AT.A'))
+        self.assertFalse(_locked('AT.A'))
+        self.assertFalse(_locked('AT.B'))
+        self.assertEqual(finac.account_balance('at.b'), 15)
+        try:
+            with finac.atomic():
+                finac.transaction_move(ct='at.a', dt='at.b', amount=3)
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        self.assertEqual(finac.account_balance('at.b'), 15)
+        self.assertEqual(len(list(finac.account_statement('at.b'))), 2)
+        finac.asset_delete('AT1')
+        finac.cleanup()
+
+    def test922_transaction_post(self):
+        finac.asset_create('TP1')
+        finac.account_create('TP.A', 'TP1', max_overdraft=100)
+        finac.account_create('TP.B', 'TP1')
+        futures = [
+            finac.transaction_post(ct='tp.a', dt='tp.b', amount=30)
+            for i in range(4)
+        ]
+        results = []
+        for f in futures:
+            try:
+                results.append(f.result())
+            except finac.OverdraftError:
+                results.append(None)
+        self.assertIsNone(results[3])
+        self.assertEqual(results[:3], sorted(results[:3]))
+        self.assertEqual(finac.account_balance('tp.b'), 90)
+        self.assertIsNotNone(
+            finac.transaction_post(ct='tp.a', dt='tp.b', amount=10).result())
+        self.assertEqual(finac.account_balance('tp.a'), -100)
+        finac.asset_delete('TP1')
+        finac.cleanup()
+
+    def test923_sqlite_wal(self):
+        if config.remote or not finac.config.sqlite_wal:
+            return
+        self.assertEqual(
+            finac.core.get_db().execute('pragma journal_mode').fetchone()[0],
+            'wal')
+        finac.asset_create('SW1')
+        for a in ('SW.A', 'SW.B', 'SW.C'):
+            finac.account_create(a, 'SW1')
+        errors = []
+
+        def _writer(ct, dt):
+            try:
+                for _ in range(20):
+                    with finac.atomic():
+                        finac.transaction_move(ct=ct, dt=dt, amount=1)
+                        finac.transaction_move(ct=dt, dt=ct, amount=1)
+            except Exception as e:
+                errors.append(e)
+
+        def _reader():
+            try:
+                with finac.session():
+                    for _ in range(20):
+                        finac.account_balance('sw.a')
+            except Exception as e:
+                errors.append(e)
+
+        def _rates():
+            try:
+                for i in range(20):
+                    finac.asset_set_rate('SW1',
+                                         'USD',
+                                         value=i + 1,
+                                         date=datetime.datetime(2019, 1, i + 1))
+            except Exception as e:
+                errors.append(e)
+
+        workers = [
+            threading.Thread(target=_writer, args=args)
+            for args in [('sw.a', 'sw.b'), ('sw.b', 'sw.c'), ('sw.c', 'sw.a')]
+        ] + [threading.Thread(target=_reader) for _ in range(3)
+            ] + [threading.Thread(target=_rates)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        self.assertEqual(errors, [])
+        for a in ('sw.a', 'sw.b', 'sw.c'):
+            self.assertEqual(finac.account_balance(a), 0)
+        finac.asset_delete('SW1')
+        finac.cleanup()
+
+    def test924_query_get(self):
+        if config.remote:
+            return
+        import finac.api as api
+        finac.asset_create('QG1')
+        finac.account_create('QG.A', 'QG1')
+        finac.transaction_create('qg.a', 10, note='qg')
+        client = api.app.test_client()
+        q = 'select account_statement(account="qg.a")'
+        r = client.get('/query', query_string={'q': q})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json['rows'], 1)
+        self.assertEqual(r.json['result'][0]['note'], 'qg')
+        r = client.get('/query', query_string={'q': q, 'time_ms': '1'})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(len(r.json['rows']), 1)
+        if finac.core.msgpack is not None:
+            r = client.get('/query',
+                           query_string={'q': q},
+                           headers={'Accept': finac.core.MSGPACK_MIME})
+            self.assertEqual(r.mimetype, finac.core.MSGPACK_MIME)
+            result = finac.core.msgpack_unpackb(r.data)
+            self.assertEqual(result['result'][0]['note'], 'qg')
+        r = client.get('/query',
+                       query_string={'q': q.replace('qg.a', 'qg.x')})
+        self.assertEqual(r.status_code, 404)
+        finac.asset_delete('QG1')
+        finac.cleanup()
+
+    def test925_atomic_rollback_cache(self):
+        if config.remote:
+            return
+        finac.asset_create('GH1')
+        try:
+            with finac.atomic():
+                finac.asset_create('GH2')
+                finac.account_create('GH.GHOST', 'GH2')
+                finac.transaction_create('gh.ghost', 10)
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        finac.asset_create('GH3')
+        finac.account_create('GH.REAL', 'GH3')
+        self.assertRaises(finac.ResourceNotFound, finac.transaction_create,
+                          'gh.ghost', 10)
+        self.assertRaises(finac.ResourceNotFound, finac.account_create,
+                          'GH.GHOST2', 'GH2')
+        self.assertEqual(finac.account_balance('gh.real'), 0)
+        finac.asset_delete('GH1')
+        finac.asset_delete('GH3')
+        finac.cleanup()
+
+    def test926_atomic_concurrent_moves(self):
+        if config.remote:
+            if finac.config.lock_mode == 'db' or finac.config.sqlite_wal:
+                self.assertRaises(RuntimeError, finac.core.account_lock,
+                                  'usd', None)
+            return
+        finac.asset_create('AC1')
+        for a in ('AC.A', 'AC.B', 'AC.C'):
+            finac.account_create(a, 'AC1')
+        errors = []
+
+        def _atomic():
+            try:
+                for _ in range(20):
+                    with finac.atomic():
+                        finac.transaction_move(ct='ac.a', dt='ac.b', amount=1)
+                        finac.transaction_move(ct='ac.b', dt='ac.c', amount=1)
+            except Exception as e:
+                errors.append(e)
+
+        def _plain():
+            try:
+                for _ in range(40):
+                    finac.transaction_move(ct='ac.c', dt='ac.a', amount=1)
+            except Exception as e:
+                errors.append(e)
+
+        finac.core.config_set('lock_timeout', 10)
+        try:
+            workers = [
+                threading.Thread(target=_atomic),
+                threading.Thread(target=_plain)
+            ]
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+        finally:
+            finac.core.config_set('lock_timeout', None)
+        self.assertEqual(errors, [])
+        self.assertEqual(finac.account_balance('ac.a'), 20)
+        self.assertEqual(finac.account_balance('ac.b'), 0)
+        self.assertEqual(finac.account_balance('ac.c'), -20)
+        finac.asset_delete('AC1')
+        finac.cleanup()
+
+    def test927_balance_range_rates(self):
+        finac.asset_create('BR1')
+        finac.asset_create('BR2')
+        finac.account_create('BR.A', 'BR1', 'credit')
+        finac.account_create('BR.B', 'BR2', 'credit')
+        finac.transaction_create('br.a', 100, date='2019-01-01')
+        finac.transaction_create('br.b', 10, date='2019-01-01')
+        for i in range(10):
+            finac.asset_set_rate('BR1/USD',
+                                 value=i + 1,
+                                 date=datetime.datetime(2019, 1, 1 + i * 2))
+            finac.asset_set_rate('USD/BR2',
+                                 value=i + 2,
+                                 date=datetime.datetime(2019, 1, 1 + i * 3))
+        times, values = finac.account_balance_range(start='2019-01-01',
+                                                    end='2019-01-25',
+                                                    tp='credit',
+                                                    base='usd')
+        self.assertEqual(len(times), 25)
+        for t, v in zip(times, values):
+            self.assertAlmostEqual(
+                v, finac.account_balance(tp='credit', date=t, base='usd'), 2)
+        finac.asset_delete('BR1')
+        finac.asset_delete('BR2')
+        finac.cleanup()
+
+    def test928_balance_checkpoint_toggle(self):
+        if config.remote or finac.config.lock_mode == 'db':
+            return
+        finac.account_create('testc2', 'USD')
+        finac.tr('testc2', 100, date='2019-01-01 10:00')
+        finac.tr('testc2', 50, date='2019-01-03 10:00')
+        finac.core.config_set('balance_checkpoint', 'daily')
+        try:
+            self.assertEqual(
+                finac.account_balance('testc2', date='2019-01-02 12:00'), 100)
+        finally:
+            finac.core.config_set('balance_checkpoint', None)
+        # checkpoints are invalidated while disabled
+        finac.tr('testc2', 10, date='2019-01-01 11:00')
+        finac.core.config_set('balance_checkpoint', 'daily')
+        try:
+            self.assertEqual(
+                finac.account_balance('testc2', date='2019-01-02 12:00'), 110)
+            self.assertEqual(
+                finac.account_balance('testc2',
+                                      date='2019-01-02T12:00:00+00:00'), 110)
+        finally:
+            finac.core.config_set('balance_checkpoint', None)
+        finac.account_delete('testc2')
+
+    def test929_transaction_post_failure(self):
+        if config.remote:
+            return
+        finac.asset_create('TP2')
+        finac.account_create('TP.C', 'TP2')
+        finac.account_create('TP.D', 'TP2')
+        post_commit = finac.core._post_commit
+
+        def _post_commit(items):
+            raise RuntimeError('injected failure')
+
+        finac.core._post_commit = _post_commit
+        try:
+            fut = finac.transaction_post(ct='tp.c', dt='tp.d', amount=10)
+            with self.assertRaises(RuntimeError):
+                fut.result(timeout=10)
+        finally:
+            finac.core._post_commit = post_commit
+        # the writer keeps working after the failure
+        self.assertIsNotNone(
+            finac.transaction_post(ct='tp.c', dt='tp.d',
+                                   amount=10).result(timeout=10))
+        self.assertEqual(finac.account_balance('tp.d'), 10)
+        finac.asset_delete('TP2')
+        finac.cleanup()
+
+    def test930_concurrent_limited_moves(self):
+        if config.remote:
+            return
+        finac.asset_create('CL1')
+        accounts = ['CL.{}'.format(i) for i in range(16)]
+        for a in accounts:
+            finac.account_create(a, 'CL1', max_overdraft=1000)
+        errors = []
+
+        def _worker(ct, dt):
+            try:
+                for _ in range(20):
+                    finac.transaction_move(ct=ct, dt=dt, amount=1)
+            except Exception as e:
+                errors.append(e)
+
+        workers = [
+            threading.Thread(target=_worker, args=accounts[i:i + 2])
+            for i in range(0, len(accounts), 2)
+        ]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(finac.account_balance('cl.1'), 20)
+        finac.asset_delete('CL1')
+        finac.cleanup()
+
+    def test931_atomic_handled_error(self):
+        if config.remote:
+            return
+        finac.asset_create('AH1')
+        finac.account_create('AH.A', 'AH1')
+        finac.account_create('AH.B', 'AH1')
+        with finac.atomic():
+            finac.transaction_move(ct='ah.a', dt='ah.b', amount=10)
+            with self.assertRaises(finac.ResourceAlreadyExists):
+                finac.account_create('AH.A', 'AH1')
+            finac.account_create('AH.C', 'AH1', tp='holding')
+            finac.transaction_move(ct='ah.a', dt='ah.c', amount=5)
+            finac.transaction_purge()
+            finac.archive_transactions(tp='holding')
+        self.assertEqual(finac.account_balance('ah.b'), 10)
+        self.assertEqual(finac.account_balance('ah.c'), 5)
+        self.assertEqual(len(list(finac.account_statement('ah.c'))), 0)
+        finac.asset_delete('AH1')
+        finac.cleanup()
+
+    def test932_balance_range_aware(self):
+        finac.asset_create('TZ1')
+        finac.account_create('TZ.A', 'TZ1', tp='holding')
+        finac.transaction_create('tz.a',
+                                 10,
+                                 date=datetime.datetime(2019, 3, 4, 12))
+        times, values = finac.account_balance_range(
+            account='tz.a',
+            start='2019-03-03T00:00:00+00:00',
+            end='2019-03-05T00:00:00+00:00')
+        self.assertEqual(len(times), 3)
+        self.assertEqual(values[-1], 10)
+        finac.asset_set_rate('TZ1/USD', 2, date='2019-03-01')
+        times, values = finac.account_balance_range(
+            tp='holding',
+            base='usd',
+            start='2019-03-03T00:00:00+00:00',
+            end='2019-03-05T00:00:00+00:00')
+        self.assertEqual(values, [0, 0, 20])
+        finac.asset_delete('TZ1')
+        finac.cleanup()
+
+    def test933_account_list_checkpoint(self):
+        if config.remote or finac.config.lock_mode == 'db':
+            return
+        finac.asset_create('CP1')
+        finac.account_create('CP.A', 'CP1')
+        finac.account_create('CP.B', 'CP1', tp='supplier')
+        finac.tr('cp.a', 100, date='2019-01-01 10:00')
+        finac.mv(ct='cp.a', dt='cp.b', amount=30, date='2019-01-02 10:00')
+        finac.tr('cp.b', 5, date='2019-01-03 10:00')
+        dates = ('2019-01-01 09:00', '2019-01-02 12:00', '2019-01-03 12:00')
+        expected = [(list(finac.account_list(code='CP.%', date=d)),
+                     finac.account_balance(asset='cp1', base='cp1', date=d))
+                    for d in dates]
+        finac.core.config_set('balance_checkpoint', 'daily')
+        try:
+            for d, (accounts, balance) in zip(dates, expected):
+                self.assertEqual(
+                    list(finac.account_list(code='CP.%', date=d)), accounts)
+                self.assertEqual(
+                    finac.account_balance(asset='cp1', base='cp1', date=d),
+                    balance)
+            self.assertEqual(
+                finac.core.get_db().execute(
+                    sql("""select count(*) as c from balance_checkpoint
+                    join account on account_id=account.id
+                    where code like 'CP.%'""")).fetchone().c, 6)
+        finally:
+            finac.core.config_set('balance_checkpoint', None)
+        finac.asset_delete('CP1')
+        finac.cleanup()
+
 
 if __name__ == '__main__':
     import argparse
@@ -880,6 +1851,10 @@ if __name__ == '__main__':
     ap.add_argument('--redis',
                     help='test Redis locking (local only)',
                     action='store_true')
+    ap.add_argument('--lock-mode', help='account lock mode', metavar='MODE')
+    ap.add_argument('--sqlite-wal',
+                    help='use SQLite WAL mode',
+                    action='store_true')
     a = ap.parse_args()
     try:
         if a.debug:
@@ -889,10 +1864,11 @@ if __name__ == '__main__':
         pass
     config.remote = a.remote
     if a.dbconn == TEST_DB:
-        try:
-            os.unlink(TEST_DB)
-        except:
-            pass
+        for f in (TEST_DB, TEST_DB + '-wal', TEST_DB + '-shm'):
+            try:
+                os.unlink(f)
+            except:
+                pass
     if a.redis:
         import redis
         redis.Redis(host='localhost', db=9).flushdb()
@@ -901,7 +1877,10 @@ if __name__ == '__main__':
     if db_uri.find('://') == -1:
         db_uri = 'sqlite:///' + os.path.expanduser(db_uri)
     dbconn = sqlalchemy.create_engine(db_uri).connect()
-    for tbl in ['transact', 'account', 'asset_rate', 'asset']:
+    for tbl in [
+            'balance_checkpoint', 'account_balance_current', 'transact',
+            'account', 'asset_rate', 'asset'
+    ]:
         try:
             dbconn.execute(sql('drop table {}'.format(tbl)))
         except (sqlalchemy.exc.ProgrammingError,
@@ -921,7 +1900,8 @@ if __name__ == '__main__':
         log = logging.getLogger('werkzeug')
         log.setLevel(logging.ERROR)
         f.init(db='{a.dbconn}',keep_integrity=True,multiplier={a.multiplier},
-            {rh},redis_db=9,insecure=True, rate_cache_ttl=0.1)
+            {rh},redis_db=9,insecure=True, rate_cache_ttl=0.1,
+            lock_mode={a.lock_mode!r}, sqlite_wal={a.sqlite_wal})
         api.key = 'secret'
         app = api.app
         app.run(host='127.0.0.1', port={service_port})
@@ -949,6 +1929,8 @@ if __name__ == '__main__':
                    redis_db=9,
                    insecure=True,
                    rate_cache_ttl=0.5,
+                   lock_mode=a.lock_mode,
+                   sqlite_wal=a.sqlite_wal,
                    custom_account_types=CUSTOM_ACCOUNT_TYPES)
         finac.core.rate_cache = None
     test_suite = unittest.TestLoader().loadTestsFromTestCase(Test)
@@ -957,5 +1939,9 @@ if __name__ == '__main__':
         server.kill()
         os.unlink(server_file)
     if a.dbconn == TEST_DB:
-        os.unlink(TEST_DB)
+        for f in (TEST_DB, TEST_DB + '-wal', TEST_DB + '-shm'):
+            try:
+                os.unlink(f)
+            except FileNotFoundError:
+                pass
     sys.exit(not test_result.wasSuccessful())